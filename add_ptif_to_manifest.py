@@ -4,19 +4,187 @@ Script to add PTIF files to IIIF manifest for PDF files.
 This script manually modifies the IIIF manifest resource to include PDF PTIF files.
 
 Run this script with:
-  source .venv/bin/activate && python add_ptif_to_manifest.py
+  source .venv/bin/activate && python add_ptif_to_manifest.py [--verbose] [--insecure]
 """
 
 import os
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import pyvips
 import requests
+import urllib3
 from flask import current_app
 from invenio_app.factory import create_api
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Create Flask application
 app = create_api()
 
+# Shared HTTP session so all manifest requests reuse one pooled connection
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    ),
+)
+# Verify the local development server against its pinned CA bundle, so TLS
+# sessions can be resumed across requests instead of disabling verification.
+# Its certificate is self-signed, so the system CAs cannot verify it; run with
+# --insecure to skip verification when no bundle is available
+DEV_CA_BUNDLE = os.environ.get(
+    "ZENODO_DEV_CA_BUNDLE", "/etc/ssl/localcerts/zenodo-dev.pem"
+)
+INSECURE = "--insecure" in sys.argv
+if os.path.exists(DEV_CA_BUNDLE):
+    SESSION.verify = DEV_CA_BUNDLE
+elif INSECURE:
+    print(f"WARNING: CA bundle {DEV_CA_BUNDLE} not found, TLS verification is disabled")
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    SESSION.verify = False
+else:
+    sys.exit(
+        f"CA bundle for the development server not found: {DEV_CA_BUNDLE}\n"
+        "Set ZENODO_DEV_CA_BUNDLE to the path of its certificate, or run with "
+        "--insecure to skip TLS verification."
+    )
+
+# Base URL of the IIIF API on the local development server
+IIIF_API_URL = "https://127.0.0.1:5000/api/iiif"
+
+# Constant part of the image service of every generated canvas
+IMAGE_SERVICE = {
+    "@context": "http://iiif.io/api/image/2/context.json",
+    "profile": "http://iiif.io/api/image/2/level1.json",
+}
+
+# Dump the full fetched manifest only when asked to
+VERBOSE = "--verbose" in sys.argv
+
+# On-disk cache of fetched manifests, revalidated with their ETag
+MANIFEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "zenodo-rdm")
+
+
+def dumps_manifest(manifest, indent=False):
+    """Serialize a manifest to bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(manifest, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(manifest, indent=2 if indent else None).encode("utf-8")
+
+
+@lru_cache(maxsize=32)
+def fetch_manifest(record_id):
+    """Fetch the raw IIIF manifest of a record, revalidating the local copy.
+
+    Returns the manifest body from the server or the local cache. Raises
+    ``requests.HTTPError`` on any other response, so failures are not cached.
+    """
+    manifest_url = f"{IIIF_API_URL}/record:{record_id}/manifest"
+    cache_file = os.path.join(MANIFEST_CACHE_DIR, f"manifest_{record_id}.json")
+    etag_file = f"{cache_file}.etag"
+
+    headers = {}
+    if os.path.exists(cache_file) and os.path.exists(etag_file):
+        with open(etag_file) as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    response = SESSION.get(manifest_url, headers=headers)
+    if response.status_code == 304:
+        with open(cache_file, "rb") as f:
+            return f.read()
+    if response.status_code != 200:
+        raise requests.HTTPError(
+            f"Unexpected status {response.status_code} for {manifest_url}",
+            response=response,
+        )
+
+    etag = response.headers.get("ETag")
+    if etag:
+        os.makedirs(MANIFEST_CACHE_DIR, exist_ok=True)
+        with open(cache_file, "wb") as f:
+            f.write(response.content)
+        with open(etag_file, "w") as f:
+            f.write(etag)
+    return response.content
+
+
+def read_dimensions(path):
+    """Read the width and height of an image from its header."""
+    # Only the header is needed, so avoid setting up a random-access pipeline
+    image = pyvips.Image.new_from_file(path, access="sequential", memory=False)
+    return image.width, image.height
+
+
+def build_new_canvases(record_id, ptif_files):
+    """Build one IIIF canvas per PTIF file."""
+    # libvips releases the GIL, so the header reads can run in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        dimensions = [executor.submit(read_dimensions, f["path"]) for f in ptif_files]
+    
+    record_url = f"{IIIF_API_URL}/record:{record_id}"
+    canvases = []
+    for ptif_file, future in zip(ptif_files, dimensions):
+        filename = ptif_file["filename"]
+        # Get PTIF file dimensions
+        try:
+            width, height = future.result()
+            print(f"PTIF dimensions: {width}x{height}")
+            
+            # Create a canvas for this PTIF file
+            canvas_id = f"{record_url}/canvas/{filename}"
+            iiif_base_url = f"{IIIF_API_URL}/{ptif_file['dir_pattern']}/6_/_/{filename}"
+            
+            canvases.append({
+                "@id": canvas_id,
+                "@type": "sc:Canvas",
+                "label": f"Page from {filename}",
+                "width": width,
+                "height": height,
+                "images": [
+                    {
+                        "@id": f"{canvas_id}/image",
+                        "@type": "oa:Annotation",
+                        "motivation": "sc:painting",
+                        "resource": {
+                            "@id": f"{iiif_base_url}/full/full/0/default.jpg",
+                            "@type": "dctypes:Image",
+                            "format": "image/jpeg",
+                            "width": width,
+                            "height": height,
+                            "service": {"@id": iiif_base_url, **IMAGE_SERVICE}
+                        },
+                        "on": canvas_id
+                    }
+                ]
+            })
+            
+        except Exception as e:
+            print(f"Error processing PTIF file {filename}: {str(e)}")
+    return canvases
+
+
+def merge_canvases(manifest, new_canvases):
+    """Return a manifest with ``new_canvases`` appended to its first sequence.
+
+    Only the containers on the path to the canvases list are copied; all
+    other sections and the existing canvases are shared with ``manifest``.
+    """
+    sequences = manifest.get("sequences") or [{}]
+    sequence = {**sequences[0]}
+    sequence["canvases"] = [*sequence.get("canvases", []), *new_canvases]
+    return {**manifest, "sequences": [sequence, *sequences[1:]]}
+
+
 def add_ptif_to_manifest():
     """Add PTIF files to IIIF manifest for PDF files."""
     with app.app_context():
@@ -26,17 +194,16 @@ def add_ptif_to_manifest():
         for record_id in record_ids:
             try:
                 # Get the current manifest to see what's there
-                manifest_url = f"https://127.0.0.1:5000/api/iiif/record:{record_id}/manifest"
-                
-                # Allow self-signed certificates for local development
-                response = requests.get(manifest_url, verify=False)
-                if response.status_code != 200:
-                    print(f"Failed to get manifest for record {record_id}: {response.status_code}")
+                try:
+                    body = fetch_manifest(record_id)
+                except requests.HTTPError as e:
+                    print(f"Failed to get manifest for record {record_id}: {e.response.status_code}")
                     continue
                 
-                manifest = response.json()
+                manifest = json.loads(body)
                 print(f"Got manifest for record {record_id}")
-                print(f"Manifest: {json.dumps(manifest, indent=2)}")
+                if VERBOSE:
+                    print(f"Manifest: {dumps_manifest(manifest).decode()}")
                 
                 # Check if the manifest has any canvases
                 sequence = manifest.get("sequences", [{}])[0]
@@ -53,13 +220,14 @@ def add_ptif_to_manifest():
                     dir_pattern = os.path.join(images_dir, pattern_prefix, "6_", "_")
                     if os.path.exists(dir_pattern):
                         print(f"Checking directory: {dir_pattern}")
-                        for filename in os.listdir(dir_pattern):
-                            if filename.endswith(".ptif") and os.path.isfile(os.path.join(dir_pattern, filename)):
-                                ptif_files.append({
-                                    "filename": filename,
-                                    "path": os.path.join(dir_pattern, filename),
-                                    "dir_pattern": pattern_prefix
-                                })
+                        with os.scandir(dir_pattern) as entries:
+                            for entry in entries:
+                                if entry.name.endswith(".ptif") and entry.is_file(follow_symlinks=False):
+                                    ptif_files.append({
+                                        "filename": entry.name,
+                                        "path": entry.path,
+                                        "dir_pattern": pattern_prefix
+                                    })
                 
                 print(f"Found {len(ptif_files)} PTIF files: {ptif_files}")
                 
@@ -67,64 +235,13 @@ def add_ptif_to_manifest():
                 if ptif_files and not canvases:
                     print("Creating canvases for PTIF files...")
                     
-                    # For each PTIF file, we need to create a canvas in the manifest
-                    from invenio_iiif.utils import iiif_image_key
-                    
-                    for ptif_file in ptif_files:
-                        filename = ptif_file["filename"]
-                        # Get PTIF file dimensions
-                        import pyvips
-                        try:
-                            image = pyvips.Image.new_from_file(ptif_file["path"])
-                            width = image.width
-                            height = image.height
-                            print(f"PTIF dimensions: {width}x{height}")
-                            
-                            # Create a canvas for this PTIF file
-                            canvas_id = f"https://127.0.0.1:5000/api/iiif/record:{record_id}/canvas/{filename}"
-                            iiif_base_url = f"https://127.0.0.1:5000/api/iiif/{ptif_file['dir_pattern']}/6_/_/{filename}"
-                            
-                            canvas = {
-                                "@id": canvas_id,
-                                "@type": "sc:Canvas",
-                                "label": f"Page from {filename}",
-                                "width": width,
-                                "height": height,
-                                "images": [
-                                    {
-                                        "@id": f"{canvas_id}/image",
-                                        "@type": "oa:Annotation",
-                                        "motivation": "sc:painting",
-                                        "resource": {
-                                            "@id": f"{iiif_base_url}/full/full/0/default.jpg",
-                                            "@type": "dctypes:Image",
-                                            "format": "image/jpeg",
-                                            "width": width,
-                                            "height": height,
-                                            "service": {
-                                                "@id": iiif_base_url,
-                                                "@context": "http://iiif.io/api/image/2/context.json",
-                                                "profile": "http://iiif.io/api/image/2/level1.json"
-                                            }
-                                        },
-                                        "on": canvas_id
-                                    }
-                                ]
-                            }
-                            
-                            # Add the canvas to the manifest
-                            canvases.append(canvas)
-                            
-                        except Exception as e:
-                            print(f"Error processing PTIF file {filename}: {str(e)}")
-                    
-                    # Update the manifest with the new canvases
-                    manifest["sequences"][0]["canvases"] = canvases
+                    new_canvases = build_new_canvases(record_id, ptif_files)
+                    manifest = merge_canvases(manifest, new_canvases)
                     
                     # Write the updated manifest to a file
                     output_file = f"manifest_{record_id}.json"
-                    with open(output_file, "w") as f:
-                        json.dump(manifest, f, indent=2)
+                    with open(output_file, "wb") as f:
+                        f.write(dumps_manifest(manifest, indent=True))
                     
                     print(f"Updated manifest written to {output_file}")
                     print("Next steps:")
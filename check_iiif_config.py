@@ -1,24 +1,29 @@
+import os
+
 from flask import current_app
 from invenio_app.factory import create_app
 
 app = create_app()
 with app.app_context():
+    cfg = current_app.config
+    exts = current_app.extensions
+    
     # Check IIIF configurations
     print("Checking IIIF configuration...")
-    print(f"RDM_RECORDS_MEDIA_FILES_ENABLED: {current_app.config.get('RDM_RECORDS_MEDIA_FILES_ENABLED', False)}")
-    print(f"IIIF_PREVIEW_ENABLED: {current_app.config.get('IIIF_PREVIEW_ENABLED', False)}")
-    print(f"PREVIEW_MAX_FILE_SIZE: {current_app.config.get('PREVIEW_MAX_FILE_SIZE', 'N/A')}")
-    print(f"PREVIEW_EXTENSIONS: {current_app.config.get('PREVIEW_EXTENSIONS', [])}")
-    print(f"PREVIEW_MIME_TYPES: {current_app.config.get('PREVIEW_MIME_TYPES', [])}")
+    print(f"RDM_RECORDS_MEDIA_FILES_ENABLED: {cfg.get('RDM_RECORDS_MEDIA_FILES_ENABLED', False)}")
+    print(f"IIIF_PREVIEW_ENABLED: {cfg.get('IIIF_PREVIEW_ENABLED', False)}")
+    print(f"PREVIEW_MAX_FILE_SIZE: {cfg.get('PREVIEW_MAX_FILE_SIZE', 'N/A')}")
+    print(f"PREVIEW_EXTENSIONS: {cfg.get('PREVIEW_EXTENSIONS', [])}")
+    print(f"PREVIEW_MIME_TYPES: {cfg.get('PREVIEW_MIME_TYPES', [])}")
     
     # Check Mirador configuration
     print("\nChecking Mirador configuration...")
-    print(f"RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE: {current_app.config.get('RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE', 'N/A')}")
-    print(f"IIIF_FORMATS: {current_app.config.get('IIIF_FORMATS', {})}")
+    print(f"RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE: {cfg.get('RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE', 'N/A')}")
+    print(f"IIIF_FORMATS: {cfg.get('IIIF_FORMATS', {})}")
     
     # Check UI preview settings
     print("\nChecking UI preview settings...")
-    rdm_extension = current_app.extensions.get('invenio-rdm-records', None)
+    rdm_extension = exts.get('invenio-rdm-records', None)
     if rdm_extension:
         service_config = getattr(rdm_extension, 'service_records_config', None)
         if service_config:
@@ -32,10 +37,9 @@ with app.app_context():
     
     # Check storage paths
     print("\nChecking storage paths...")
-    iiif_path = current_app.config.get('IIIF_STORAGE_PATH', 'N/A')
+    iiif_path = cfg.get('IIIF_STORAGE_PATH', 'N/A')
     print(f"IIIF storage path: {iiif_path}")
     
-    import os
     if iiif_path != 'N/A' and os.path.exists(iiif_path):
         print(f"IIIF storage path exists: Yes")
         print(f"IIIF storage path contents: {os.listdir(iiif_path)}")
@@ -57,7 +61,7 @@ with app.app_context():
     print("\nChecking file previewers...")
     try:
         from invenio_previewer.ext import InvenioPreviewer
-        previewer_ext = current_app.extensions.get('invenio-previewer', None)
+        previewer_ext = exts.get('invenio-previewer', None)
         if previewer_ext:
             print(f"Registered previewers: {list(previewer_ext.previewers.keys())}")
             
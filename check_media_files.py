@@ -5,12 +5,21 @@ Run this script with:
   source .venv/bin/activate && python check_media_files.py
 """
 
+from functools import lru_cache
+
 from invenio_app.factory import create_api
 from invenio_rdm_records.records.api import RDMRecord
 
 # Create Flask application
 app = create_api()
 
+
+@lru_cache(maxsize=1024)
+def get_record(record_id):
+    """Get a record, reusing it if it was already loaded in this run."""
+    return RDMRecord.get_record(record_id)
+
+
 def check_media_files():
     """Check media files for records."""
     with app.app_context():
@@ -20,7 +29,7 @@ def check_media_files():
         ]
         
         for record_id in record_ids:
-            record = RDMRecord.get_record(record_id)
+            record = get_record(record_id)
             print(f"Record ID: {record.id}")
             print(f"Record bucket ID: {record.media_files.bucket_id}")
             print(f"Record files: {list(record.files.keys())}")
@@ -36,6 +45,9 @@ def check_media_files():
                 print(f"  Processor status: {processor.get('status', 'unknown')}")
                 print(f"  File metadata: {file_obj}")
                 print()
+        
+        # Records are bound to this app context, don't keep them around
+        get_record.cache_clear()
 
 if __name__ == "__main__":
     check_media_files() 
\ No newline at end of file
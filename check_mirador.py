@@ -4,19 +4,21 @@ app = create_app()
 print('Checking IIIF and Mirador configuration:')
 
 with app.app_context():
+    cfg = app.config
+    
     # Check IIIF configuration
-    print(f"IIIF_PREVIEW_ENABLED: {app.config.get('IIIF_PREVIEW_ENABLED', False)}")
-    print(f"RDM_RECORDS_MEDIA_FILES_ENABLED: {app.config.get('RDM_RECORDS_MEDIA_FILES_ENABLED', False)}")
+    print(f"IIIF_PREVIEW_ENABLED: {cfg.get('IIIF_PREVIEW_ENABLED', False)}")
+    print(f"RDM_RECORDS_MEDIA_FILES_ENABLED: {cfg.get('RDM_RECORDS_MEDIA_FILES_ENABLED', False)}")
     
     # Check Mirador configuration
-    print(f"MIRADOR_PREVIEW_EXTENSIONS: {app.config.get('MIRADOR_PREVIEW_EXTENSIONS', [])}")
-    print(f"RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE: {app.config.get('RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE', 'N/A')}")
+    print(f"MIRADOR_PREVIEW_EXTENSIONS: {cfg.get('MIRADOR_PREVIEW_EXTENSIONS', [])}")
+    print(f"RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE: {cfg.get('RDM_RECORDS_UI_FILES_PREVIEW_IIIF_MIRADOR_BASE_TEMPLATE', 'N/A')}")
     
     # Check previewer preference
-    print(f"PREVIEWER_PREFERENCE: {app.config.get('PREVIEWER_PREFERENCE', [])}")
+    print(f"PREVIEWER_PREFERENCE: {cfg.get('PREVIEWER_PREFERENCE', [])}")
     
     # Check IIIF formats
-    print(f"IIIF_FORMATS: {app.config.get('IIIF_FORMATS', {})}")
+    print(f"IIIF_FORMATS: {cfg.get('IIIF_FORMATS', {})}")
     
     # Check for the zenodo-previewer extension
     print(f"zenodo-previewer extension loaded: {'zenodo-previewer' in app.extensions}")
@@ -39,7 +41,7 @@ with app.app_context():
         print(f"Import error: {e}")
     
     # Check IIIF storage path
-    iiif_path = app.config.get('IIIF_STORAGE_PATH', 'N/A')
+    iiif_path = cfg.get('IIIF_STORAGE_PATH', 'N/A')
     print(f"IIIF storage path: {iiif_path}")
     
     import os
@@ -13,107 +13,162 @@ Usage:
 import os
 import sys
 import time
+from collections import Counter
 from invenio_app.factory import create_app
 from invenio_db import db
 from invenio_records_resources.records.systemfields.files import FilesField
 from invenio_records_resources.records.api import Record
 from invenio_files_rest.models import FileInstance, ObjectVersion
+from invenio_rdm_records.records.api import RDMFileRecord, RDMMediaFileRecord, RDMRecord
+from sqlalchemy.orm import joinedload, selectinload
 
 # Create Flask application
 app = create_app()
 
+# Number of records loaded from the database at a time
+CHUNK_SIZE = 500
+
+
+def load_chunk(ids):
+    """Load a chunk of records together with their files and media files.
+
+    Buckets, file keys and media file records (including their object versions
+    and file instances) are fetched with one query each for the whole chunk,
+    instead of lazily per record.
+    """
+    model_cls = RDMRecord.model_cls
+    models = model_cls.query.options(
+        selectinload(model_cls.bucket),
+        selectinload(model_cls.media_bucket),
+    ).filter(
+        model_cls.id.in_(ids),
+        model_cls.is_deleted != True,  # noqa
+    ).all()
+
+    file_keys = {}
+    rows = db.session.execute(
+        db.select(RDMFileRecord.model_cls.record_id, RDMFileRecord.model_cls.key)
+        .where(RDMFileRecord.model_cls.record_id.in_(ids))
+    )
+    for record_id, key in rows:
+        file_keys.setdefault(record_id, []).append(key)
+
+    media_files = {}
+    media_model_cls = RDMMediaFileRecord.model_cls
+    media_models = media_model_cls.query.options(
+        joinedload(media_model_cls.object_version).joinedload(ObjectVersion.file)
+    ).filter(media_model_cls.record_id.in_(ids))
+    for media_model in media_models:
+        media_files.setdefault(media_model.record_id, {})[media_model.key] = (
+            RDMMediaFileRecord(media_model.data, model=media_model)
+        )
+
+    for model in models:
+        record = RDMRecord(model.data, model=model)
+        yield record, file_keys.get(model.id, []), media_files.get(model.id, {})
+
+
+def pdf_record_ids_query():
+    """Query the IDs of records that have at least one PDF file."""
+    file_model_cls = RDMFileRecord.model_cls
+    return db.select(file_model_cls.record_id).where(
+        file_model_cls.key.ilike('%.pdf')
+    ).distinct()
+
+
+def iter_records(chunk_size=CHUNK_SIZE):
+    """Stream records with PDF files, loading them one chunk at a time."""
+    ids = db.session.execute(
+        pdf_record_ids_query()
+    ).scalars().yield_per(chunk_size)
+    for chunk in ids.partitions():
+        yield from load_chunk(chunk)
+
+
 def check_pdf_files():
     """Check the status of PDF PTIF files."""
     start_time = time.time()
     
     # Statistics
     total_records = 0
-    records_with_media_files = 0
-    pdf_records = 0
-    pdf_with_ptif = 0
-    ptif_init_status = 0
-    ptif_processing_status = 0
-    ptif_finished_status = 0
-    pdf_without_ptif = 0
+    pdf_candidates = 0
+    stats = Counter()
+    ptif_statuses = Counter()
     
     # Get all record UUIDs
     with app.app_context():
-        from invenio_rdm_records.records.api import RDMRecord
-        records = RDMRecord.model_cls.query.all()
-        total_records = len(records)
+        total_records = RDMRecord.model_cls.query.count()
+        pdf_candidates = db.session.execute(
+            db.select(db.func.count()).select_from(pdf_record_ids_query().subquery())
+        ).scalar()
         
-        print(f"Found {total_records} records to check")
+        print(f"Found {total_records} records, {pdf_candidates} with PDF files to check")
         
-        for record_model in records:
+        for record, file_keys, media_files in iter_records():
+            # Collect the report of each record and write it out at once
+            lines = []
             try:
-                # Load the record
-                record_id = str(record_model.id)
-                record = RDMRecord.get_record(record_model.id)
-                print(f"\nChecking record: {record_id}")
+                record_id = str(record.id)
+                lines.append(f"\nChecking record: {record_id}")
                 
                 # Check if media files are enabled
                 if not hasattr(record, 'media_files') or not record.media_files.enabled:
-                    print("  Media files not enabled")
+                    lines.append("  Media files not enabled")
                     continue
                 
-                records_with_media_files += 1
+                stats['records_with_media_files'] += 1
                 
                 # Look for PDF files
                 has_pdf = False
-                for filename in record.files:
+                for filename in file_keys:
                     if filename.lower().endswith('.pdf'):
                         has_pdf = True
-                        pdf_records += 1
-                        print(f"  Found PDF file: {filename}")
+                        stats['pdf_records'] += 1
+                        lines.append(f"  Found PDF file: {filename}")
                         
                         # Check if PTIF exists
                         ptif_filename = f"{filename}.ptif"
-                        if ptif_filename in record.media_files:
-                            pdf_with_ptif += 1
-                            ptif_file = record.media_files[ptif_filename]
+                        if ptif_filename in media_files:
+                            stats['pdf_with_ptif'] += 1
+                            ptif_file = media_files[ptif_filename]
                             status = ptif_file.processor.get('status') if hasattr(ptif_file, 'processor') and ptif_file.processor else 'unknown'
-                            print(f"  PTIF exists with status: {status}")
+                            lines.append(f"  PTIF exists with status: {status}")
+                            ptif_statuses[status] += 1
                             
-                            # Track status
-                            if status == 'init':
-                                ptif_init_status += 1
-                            elif status == 'processing':
-                                ptif_processing_status += 1
-                            elif status == 'finished':
-                                ptif_finished_status += 1
-                                
                             # Print PTIF file path
                             if hasattr(ptif_file, 'file') and ptif_file.file:
-                                print(f"  PTIF file path: {ptif_file.file.uri}")
+                                lines.append(f"  PTIF file path: {ptif_file.file.uri}")
                                 
                                 # Check if file physically exists
-                                if os.path.exists(ptif_file.file.uri):
-                                    print(f"  PTIF file exists on disk")
-                                    file_size = os.path.getsize(ptif_file.file.uri)
-                                    print(f"  PTIF file size: {file_size} bytes")
-                                else:
-                                    print(f"  WARNING: PTIF file does not exist on disk!")
+                                try:
+                                    st = os.stat(ptif_file.file.uri)
+                                    lines.append(f"  PTIF file exists on disk")
+                                    lines.append(f"  PTIF file size: {st.st_size} bytes")
+                                except FileNotFoundError:
+                                    lines.append(f"  WARNING: PTIF file does not exist on disk!")
                         else:
-                            pdf_without_ptif += 1
-                            print(f"  No PTIF file found for PDF {filename}")
+                            stats['pdf_without_ptif'] += 1
+                            lines.append(f"  No PTIF file found for PDF {filename}")
                 
                 if not has_pdf:
-                    print("  No PDF files found in this record")
+                    lines.append("  No PDF files found in this record")
                     
             except Exception as e:
-                print(f"Error processing record {record_id}: {str(e)}")
+                lines.append(f"Error processing record {record_id}: {str(e)}")
+            finally:
+                sys.stdout.write("\n".join(lines) + "\n")
     
     elapsed_time = time.time() - start_time
     
     print("\n===== PDF PTIF Files Check Summary =====")
     print(f"Total records: {total_records}")
-    print(f"Records with media files enabled: {records_with_media_files}")
-    print(f"Records with PDF files: {pdf_records}")
-    print(f"PDF files with PTIF: {pdf_with_ptif}")
-    print(f"PTIF files with 'init' status: {ptif_init_status}")
-    print(f"PTIF files with 'processing' status: {ptif_processing_status}")
-    print(f"PTIF files with 'finished' status: {ptif_finished_status}")
-    print(f"PDF files without PTIF: {pdf_without_ptif}")
+    print(f"Records checked (with PDF files): {pdf_candidates}")
+    print(f"Records with media files enabled: {stats['records_with_media_files']}")
+    print(f"Records with PDF files: {stats['pdf_records']}")
+    print(f"PDF files with PTIF: {stats['pdf_with_ptif']}")
+    for status, count in ptif_statuses.most_common():
+        print(f"PTIF files with '{status}' status: {count}")
+    print(f"PDF files without PTIF: {stats['pdf_without_ptif']}")
     print(f"Elapsed time: {elapsed_time:.2f} seconds")
     print("=========================================")
 
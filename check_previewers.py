@@ -1,7 +1,18 @@
+from importlib.metadata import entry_points
+
 from invenio_app.factory import create_app
-from pkg_resources import iter_entry_points
 
 app = create_app()
+
+
+def previewer_entry_points(group='invenio_previewer.previewers'):
+    """Return the previewer entry points without scanning via pkg_resources."""
+    eps = entry_points()
+    # Python < 3.10 returns a dict of groups instead of a selectable collection
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
 print('Checking registered previewers:')
 
 with app.app_context():
@@ -16,8 +27,8 @@ with app.app_context():
     
     # Force registration of previewers
     print("Discovering previewers from entry points...")
-    for entry_point in iter_entry_points(group='invenio_previewer.previewers'):
-        print(f"Found previewer entry point: {entry_point.name} -> {entry_point.module_name}")
+    for entry_point in previewer_entry_points():
+        print(f"Found previewer entry point: {entry_point.name} -> {entry_point.value}")
         if entry_point.name not in previewer_ext.previewers:
             module = entry_point.load()
             if hasattr(module, 'can_preview') and hasattr(module, 'preview'):
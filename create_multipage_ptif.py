@@ -4,158 +4,334 @@ Script to create a proper multi-page PTIF file for a PDF.
 This will create a single PTIF file containing all pages of a PDF.
 
 Run this script with:
-  source .venv/bin/activate && python create_multipage_ptif.py
+  source .venv/bin/activate && python create_multipage_ptif.py [--force]
+
+Use --force to regenerate PTIF files that are already up to date.
 """
 
 import os
 import sys
 import json
-import subprocess
 import shutil
 import re
+import queue
+import threading
+
+# Number of concurrent conversion workers
+NUM_WORKERS = min(os.cpu_count() or 1, 4)
+
+# libvips reads these when it is initialized, so they must be set before
+# import. The cores are shared out between the workers' libvips pipelines,
+# so that together they do not oversubscribe the machine
+os.environ.setdefault(
+    "VIPS_CONCURRENCY", str(max(1, (os.cpu_count() or 1) // NUM_WORKERS))
+)
+os.environ.setdefault("VIPS_DISC_THRESHOLD", "1g")
+
+import pyvips
 from invenio_app.factory import create_api
 from invenio_db import db
 from invenio_files_rest.models import ObjectVersion, Bucket
 from flask import current_app
+from ptif_utils import is_up_to_date
 
 # Create Flask application
 app = create_api()
 
+# Let libvips reuse decoded regions across the conversions of this run
+pyvips.cache_set_max_mem(512 * 1024 * 1024)
+pyvips.cache_set_max(1000)
+
+# Bound of the task/result queues
+QUEUE_SIZE = 2 * NUM_WORKERS
+
+# Largest page dimension rendered into the PTIF, enough for IIIF viewers
+MAX_PAGE_SIZE = 8192
+
+# Sentinel telling a worker or the writer to stop
+STOP = None
+
+# Record whose PTIF is also served from the "20" IIIF directory
+SECOND_RECORD_ID = "d8ca5052-6704-41e7-aadf-4d021b7f4bdd"
+
+# Regenerate PTIF files even if they are up to date
+FORCE = "--force" in sys.argv
+
+
+def destination_paths(record_id, ptif_filename, images_dir):
+    """Get the IIIF directory paths a record's PTIF file is served from."""
+    # We know from our investigation that it's 'public/21/6_/_/history00871.pdf.ptif' for the first record
+    # Let's use this pattern for both records
+    paths = [os.path.join(images_dir, "21", "6_", "_", ptif_filename)]
+    # Also use the other known location for the second record
+    if record_id == SECOND_RECORD_ID:
+        paths.append(os.path.join(images_dir, "20", "6_", "_", ptif_filename))
+    return paths
+
+
+def find_pdf_tasks(record_ids, temp_dir, images_dir):
+    """Yield a conversion task for each PDF file of the given records.
+
+    This is the only place touching the database, so it runs in the main
+    thread which owns the SQLAlchemy session.
+    """
+    from invenio_rdm_records.records.api import RDMRecord
+    
+    for record_id in record_ids:
+        try:
+            record = RDMRecord.get_record(record_id)
+            if not record or not record.media_files.enabled:
+                print(f"Record {record_id} does not exist or media files not enabled")
+                continue
+            
+            # Check for PDF files in the record
+            pdf_files = [f for f in record.files.keys() if f.lower().endswith('.pdf')]
+            if not pdf_files:
+                print(f"No PDF files found in record {record_id}")
+                continue
+            
+            # Get files bucket ID
+            files_bucket_id = record.files.bucket_id
+            
+            # Get only the PDF file objects from the bucket, keyed by filename
+            pdf_objects = {
+                obj.key: obj
+                for obj in ObjectVersion.query.filter(
+                    ObjectVersion.bucket_id == files_bucket_id,
+                    ObjectVersion.key.in_(pdf_files),
+                    ObjectVersion.is_head == True,  # noqa
+                )
+            }
+            
+            for pdf_filename in pdf_files:
+                print(f"Processing {pdf_filename} from record {record_id}")
+                
+                # Check if the PTIF file already exists
+                ptif_filename = f"{pdf_filename}.ptif"
+                
+                # Find the PDF file object
+                pdf_obj = pdf_objects.get(pdf_filename)
+                
+                if not pdf_obj or not pdf_obj.file:
+                    print(f"Could not find file object for {pdf_filename}")
+                    continue
+                
+                # Get the actual PDF file path
+                pdf_path = pdf_obj.file.uri
+                print(f"PDF file path: {pdf_path}")
+                
+                dest_paths = destination_paths(record_id, ptif_filename, images_dir)
+                if not FORCE and all(is_up_to_date(p, pdf_path) for p in dest_paths):
+                    print(f"PTIF file for {pdf_filename} is up to date, skipping")
+                    continue
+                
+                # Records can share file names, so every record gets its own
+                # temporary directory for the conversions running in parallel
+                record_temp_dir = os.path.join(temp_dir, str(record_id))
+                os.makedirs(record_temp_dir, exist_ok=True)
+                
+                yield {
+                    "record_id": record_id,
+                    "pdf_filename": pdf_filename,
+                    "pdf_path": pdf_path,
+                    "ptif_filename": ptif_filename,
+                    "ptif_path": os.path.join(record_temp_dir, ptif_filename),
+                    "dest_paths": dest_paths,
+                }
+        
+        except Exception as e:
+            print(f"Error processing record {record_id}: {str(e)}")
+
+
+def remove_temp_file(temp_file):
+    """Remove a temporary file if it exists."""
+    if os.path.exists(temp_file):
+        try:
+            os.remove(temp_file)
+            print(f"Removed temporary file: {temp_file}")
+        except:
+            print(f"Could not remove temporary file: {temp_file}")
+
+
+def render_pdf(pdf_path, dpi, pages):
+    """Render PDF pages, each scaled down to at most ``MAX_PAGE_SIZE``.
+
+    ``pages`` selects the pages as a pdfload option, e.g. ``"n=-1"``.
+    """
+    return pyvips.Image.thumbnail(
+        f"{pdf_path}[dpi={dpi},{pages}]",
+        MAX_PAGE_SIZE,
+        crop="none",
+        size="down",
+    )
+
+
+def render_pages(pdf_path, dpi):
+    """Render all pages of a PDF as one tall strip.
+
+    Returns an ``(image, page_height)`` tuple. libvips only sets
+    ``page-height`` when all pages have the same size, so for PDFs with
+    mixed page sizes each page is rendered on its own and centred on a
+    white page of the largest size.
+    """
+    image = render_pdf(pdf_path, dpi, "n=-1")
+    if image.get_typeof("page-height") != 0:
+        return image, image.get("page-height")
+    
+    n_pages = pyvips.Image.new_from_file(pdf_path).get("n-pages")
+    pages = [render_pdf(pdf_path, dpi, f"page={i}") for i in range(n_pages)]
+    width = max(page.width for page in pages)
+    height = max(page.height for page in pages)
+    pages = [page.gravity("centre", width, height, extend="white") for page in pages]
+    return pyvips.Image.arrayjoin(pages, across=1), height
+
+
+def convert_pdf(task, dpi):
+    """Convert the PDF of a task to a multi-page PTIF file."""
+    pdf_filename = task["pdf_filename"]
+    ptif_path = task["ptif_path"]
+    try:
+        # Render all PDF pages as one tall strip and save it as a
+        # multi-page PTIF in a single in-process pipeline. thumbnail lets
+        # libvips render each page directly at the (at most) needed size
+        print(f"Converting {task['pdf_path']} to {ptif_path}")
+        image, page_height = render_pages(task["pdf_path"], dpi)
+        image.tiffsave(
+            ptif_path,
+            tile=True,
+            pyramid=True,
+            compression="jpeg",
+            Q=90,
+            tile_width=256,
+            tile_height=256,
+            page_height=page_height,
+            bigtiff=True,
+        )
+        
+        # Check if PTIF file was created successfully
+        if os.path.exists(ptif_path) and os.path.getsize(ptif_path) > 0:
+            print(f"PTIF file created successfully: {ptif_path}")
+            print(f"PTIF file size: {os.path.getsize(ptif_path)} bytes")
+            return True
+        print(f"Failed to create PTIF file for {pdf_filename}")
+    
+    except pyvips.Error as e:
+        print(f"Error converting {pdf_filename}: {e.message}")
+        print(f"libvips error: {e.detail}")
+    
+    except Exception as e:
+        print(f"Error processing {pdf_filename}: {str(e)}")
+    
+    remove_temp_file(ptif_path)
+    return False
+
+
+def link_or_copy(src, dst):
+    """Hardlink ``src`` to ``dst``, copying only across filesystems.
+
+    The link or copy is made under a temporary name next to ``dst`` and then
+    renamed over it, so an existing ``dst`` is only replaced once the new
+    file is complete.
+    """
+    tmp_dst = f"{dst}.tmp{os.getpid()}"
+    try:
+        try:
+            os.link(src, tmp_dst)
+        except OSError:
+            shutil.copy(src, tmp_dst)
+        os.replace(tmp_dst, dst)
+    except BaseException:
+        if os.path.lexists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+
+
+def install_ptif(task):
+    """Copy a converted PTIF file into the IIIF images directory."""
+    ptif_path = task["ptif_path"]
+    try:
+        # Link the PTIF into the IIIF directories, all sharing the same data
+        for dest_path in task["dest_paths"]:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            print(f"Linking PTIF to {dest_path}")
+            link_or_copy(ptif_path, dest_path)
+        
+        print(f"Successfully created PTIF file for record {task['record_id']}")
+    
+    except Exception as e:
+        print(f"Error installing {task['ptif_filename']}: {str(e)}")
+    
+    finally:
+        remove_temp_file(ptif_path)
+
+
+def conversion_worker(tasks, results, dpi):
+    """Convert tasks from the task queue and pass successes to the writer."""
+    while True:
+        task = tasks.get()
+        if task is STOP:
+            results.put(STOP)
+            return
+        if convert_pdf(task, dpi):
+            results.put(task)
+
+
+def writer(results, num_workers):
+    """Install converted PTIF files until every worker has stopped."""
+    stopped = 0
+    while stopped < num_workers:
+        task = results.get()
+        if task is STOP:
+            stopped += 1
+            continue
+        install_ptif(task)
+
+
 def create_multipage_ptif():
-    """Create a multi-page PTIF file for PDFs."""
+    """Create a multi-page PTIF file for PDFs.
+
+    The main thread reads tasks from the database, a pool of worker threads
+    runs the libvips conversions (which release the GIL) and a writer thread
+    copies the results into place, connected by bounded queues.
+    """
     with app.app_context():
-        from invenio_rdm_records.records.api import RDMRecord
-        
         # Record IDs with PDF files
         record_ids = [
             "b8902cb3-eaaf-4201-89c6-f6475085c0c3",
-            "d8ca5052-6704-41e7-aadf-4d021b7f4bdd"
+            SECOND_RECORD_ID,
         ]
         
-        for record_id in record_ids:
-            try:
-                record = RDMRecord.get_record(record_id)
-                if not record or not record.media_files.enabled:
-                    print(f"Record {record_id} does not exist or media files not enabled")
-                    continue
-                
-                # Check for PDF files in the record
-                pdf_files = [f for f in record.files.keys() if f.lower().endswith('.pdf')]
-                if not pdf_files:
-                    print(f"No PDF files found in record {record_id}")
-                    continue
-                
-                # Get files bucket ID
-                files_bucket_id = record.files.bucket_id
-                
-                # Get file objects from bucket
-                file_objects = ObjectVersion.query.filter_by(bucket_id=files_bucket_id, is_head=True).all()
-                
-                for pdf_filename in pdf_files:
-                    print(f"Processing {pdf_filename} from record {record_id}")
-                    
-                    # Check if the PTIF file already exists
-                    ptif_filename = f"{pdf_filename}.ptif"
-                    
-                    # Find the PDF file object
-                    pdf_obj = None
-                    for obj in file_objects:
-                        if obj.key == pdf_filename:
-                            pdf_obj = obj
-                            break
-                    
-                    if not pdf_obj or not pdf_obj.file:
-                        print(f"Could not find file object for {pdf_filename}")
-                        continue
-                    
-                    # Get the actual PDF file path
-                    pdf_path = pdf_obj.file.uri
-                    print(f"PDF file path: {pdf_path}")
-                    
-                    # Create temporary directory for processing
-                    temp_dir = os.path.join(current_app.instance_path, "temp_ptif_files")
-                    os.makedirs(temp_dir, exist_ok=True)
-                    
-                    # Output file paths
-                    temp_tiff_path = os.path.join(temp_dir, f"{pdf_filename}.temp.tiff")
-                    ptif_path = os.path.join(temp_dir, ptif_filename)
-                    
-                    # Get DPI from config
-                    iiif_config = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
-                    dpi = iiif_config.get("dpi", 300)
-                    
-                    try:
-                        # Use a two-step process for PDF to PTIF conversion
-                        # First convert PDF (first page only) to TIFF
-                        cmd1 = [
-                            "vips", "pdfload", pdf_path, temp_tiff_path,
-                            f"--dpi={dpi}", "--page=0"  # First page only
-                        ]
-                        
-                        print(f"Running command: {' '.join(cmd1)}")
-                        result1 = subprocess.run(cmd1, check=True, capture_output=True, text=True)
-                        
-                        # Then convert TIFF to PTIF
-                        cmd2 = [
-                            "vips", "tiffsave", temp_tiff_path, ptif_path,
-                            "--tile", "--pyramid", "--compression=jpeg",
-                            "--tile-width=256", "--tile-height=256"
-                        ]
-                        
-                        print(f"Running command: {' '.join(cmd2)}")
-                        result2 = subprocess.run(cmd2, check=True, capture_output=True, text=True)
-                        
-                        # Check if PTIF file was created successfully
-                        if os.path.exists(ptif_path) and os.path.getsize(ptif_path) > 0:
-                            print(f"PTIF file created successfully: {ptif_path}")
-                            print(f"PTIF file size: {os.path.getsize(ptif_path)} bytes")
-                            
-                            # Find the IIIF images directory
-                            images_dir = os.path.join(current_app.instance_path, "images", "public")
-                            
-                            # Determine the correct IIIF directory pattern
-                            # We know from our investigation that it's 'public/21/6_/_/history00871.pdf.ptif' for the first record
-                            # Let's use this pattern for both records
-                            iiif_dir = os.path.join(images_dir, "21", "6_", "_")
-                            os.makedirs(iiif_dir, exist_ok=True)
-                            
-                            # Copy the PTIF to the IIIF directory
-                            dest_path = os.path.join(iiif_dir, ptif_filename)
-                            print(f"Copying PTIF to {dest_path}")
-                            shutil.copy(ptif_path, dest_path)
-                            
-                            # Also copy to the other known location for the second record if needed
-                            if record_id == "d8ca5052-6704-41e7-aadf-4d021b7f4bdd":
-                                iiif_dir2 = os.path.join(images_dir, "20", "6_", "_")
-                                os.makedirs(iiif_dir2, exist_ok=True)
-                                dest_path2 = os.path.join(iiif_dir2, ptif_filename)
-                                print(f"Copying PTIF to {dest_path2}")
-                                shutil.copy(ptif_path, dest_path2)
-                            
-                            print(f"Successfully created PTIF file for record {record_id}")
-                        else:
-                            print(f"Failed to create PTIF file for {pdf_filename}")
-                            
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error converting {pdf_filename}: {e}")
-                        print(f"Command output: {e.stdout}")
-                        print(f"Command error: {e.stderr}")
-                    
-                    except Exception as e:
-                        print(f"Error processing {pdf_filename}: {str(e)}")
-                    
-                    finally:
-                        # Clean up temporary files
-                        for temp_file in [temp_tiff_path, ptif_path]:
-                            if os.path.exists(temp_file):
-                                try:
-                                    os.remove(temp_file)
-                                    print(f"Removed temporary file: {temp_file}")
-                                except:
-                                    print(f"Could not remove temporary file: {temp_file}")
-            
-            except Exception as e:
-                print(f"Error processing record {record_id}: {str(e)}")
+        # Create temporary directory for processing
+        temp_dir = os.path.join(current_app.instance_path, "temp_ptif_files")
+        os.makedirs(temp_dir, exist_ok=True)
+        
+        # Find the IIIF images directory
+        images_dir = os.path.join(current_app.instance_path, "images", "public")
+        
+        # Get DPI from config
+        iiif_config = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
+        dpi = iiif_config.get("dpi", 300)
+        
+        tasks = queue.Queue(maxsize=QUEUE_SIZE)
+        results = queue.Queue(maxsize=QUEUE_SIZE)
+        workers = [
+            threading.Thread(target=conversion_worker, args=(tasks, results, dpi))
+            for _ in range(NUM_WORKERS)
+        ]
+        writer_thread = threading.Thread(
+            target=writer, args=(results, NUM_WORKERS)
+        )
+        for thread in [*workers, writer_thread]:
+            thread.start()
+        
+        try:
+            for task in find_pdf_tasks(record_ids, temp_dir, images_dir):
+                tasks.put(task)
+        finally:
+            for _ in workers:
+                tasks.put(STOP)
+            for thread in [*workers, writer_thread]:
+                thread.join()
 
 if __name__ == "__main__":
-    create_multipage_ptif() 
\ No newline at end of file
+    create_multipage_ptif()
\ No newline at end of file
@@ -6,25 +6,173 @@ This script extracts each page from a PDF and creates separate PTIF files
 for each page to enable proper multi-page viewing in Mirador.
 
 Run this script with:
-  source .venv/bin/activate && python create_pdf_multipage_ptif.py
+  source .venv/bin/activate && python create_pdf_multipage_ptif.py [--verbose]
 """
 
 import os
-import sys
+import logging
 import time
 import json
 import subprocess
-import traceback
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of vips conversions running at the same time, across all PDFs
+VIPS_SLOTS = min(os.cpu_count() or 1, 4)
+
+# libvips reads this when it is initialized, so it must be set before
+# import. The vips command line tool inherits it as well. The cores are
+# shared out between the conversions so they do not oversubscribe the machine
+os.environ.setdefault(
+    "VIPS_CONCURRENCY", str(max(1, (os.cpu_count() or 1) // VIPS_SLOTS))
+)
+
+try:
+    import pyvips
+except ImportError:
+    # Fall back to running the vips command line tool
+    pyvips = None
+try:
+    from pypdf import PdfReader
+except ImportError:
+    # Fall back to running pdfinfo to count PDF pages
+    PdfReader = None
 from invenio_app.factory import create_api
 from invenio_db import db
 from flask import current_app
+from ptif_utils import is_up_to_date, media_pdf_records_query, setup_logging
+
+# Create Flask application
+app = create_api()
+
+# Per-page details are logged at DEBUG level, run with --verbose to see them
+logger = setup_logging(__name__)
+
+# Number of records fetched from the database at a time
+CHUNK_SIZE = 200
+
+# Page counts of the PDFs seen in this run, keyed by file path
+_page_counts = {}
+
+# Number of PDFs converted at the same time, across records. Their page
+# conversions all share the VIPS_SLOTS limit
+PDF_WORKERS = VIPS_SLOTS
+
+# Limits the number of vips conversions running at once, across all PDFs
+_vips_slots = threading.BoundedSemaphore(VIPS_SLOTS)
+
+# Loader written next to the manual PTIF files; it registers the entries
+# listed in register_ptif_files.json
+REGISTRATION_SCRIPT = '''#!/usr/bin/env python
+\"\"\"
+Script to register the manually created PTIF files.
+The files to register are read from register_ptif_files.json.
+Run this script with:
+  source .venv/bin/activate && python register_ptif_files.py
+\"\"\"
+
+import os
+import json
+from invenio_app.factory import create_api
+from invenio_db import db
+from invenio_files_rest.models import ObjectVersion
 
 # Create Flask application
 app = create_api()
 
+ENTRIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "register_ptif_files.json")
+
+def register_ptif_files():
+    \"\"\"Register the manually created PTIF files.\"\"\"
+    with open(ENTRIES_FILE) as f:
+        entries = json.load(f)
+    
+    with app.app_context():
+        from invenio_rdm_records.records.api import RDMRecord
+        
+        # Group the entries by record so each record is committed once
+        entries_by_record = {}
+        for entry in entries:
+            entries_by_record.setdefault(entry["record_id"], []).append(entry)
+        
+        for record_id, record_entries in entries_by_record.items():
+            record = RDMRecord.get_record(record_id)
+            if not record or not record.media_files.enabled:
+                continue
+            
+            registered = []
+            bucket_id = record.media_files.bucket_id
+            for entry in record_entries:
+                page_ptif_filename = entry["page_ptif_filename"]
+                manual_file_path = entry["manual_file_path"]
+                
+                # Check if file already exists
+                if page_ptif_filename in record.media_files:
+                    print(f"{page_ptif_filename} already exists in record {record_id}")
+                    continue
+                
+                try:
+                    # Create ObjectVersion for the new file; a failing page only
+                    # rolls back its own savepoint
+                    print(f"Registering {page_ptif_filename} for record {record_id}")
+                    with db.session.begin_nested():
+                        with open(manual_file_path, 'rb', buffering=1 << 20) as fh:
+                            obj = ObjectVersion.create(
+                                bucket_id, page_ptif_filename, stream=fh,
+                                size=os.path.getsize(manual_file_path)
+                            )
+                        db.session.add(obj)
+                    
+                    # Add metadata to record
+                    obj_dict = {
+                        "key": page_ptif_filename,
+                        "object_version_id": str(obj.version_id),
+                        "processor": {
+                            "status": "finished",
+                            "pdf_page": entry["page_num"],
+                            "pdf_total_pages": entry["page_count"]
+                        }
+                    }
+                    record.media_files.add(obj_dict)
+                    registered.append(page_ptif_filename)
+                except Exception as e:
+                    print(f"Error registering {page_ptif_filename}: {str(e)}")
+            
+            if not registered:
+                continue
+            
+            # Commit all pages of the record at once
+            try:
+                record.commit()
+                db.session.commit()
+                for page_ptif_filename in registered:
+                    print(f"Successfully registered {page_ptif_filename}")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error committing record {record_id}: {str(e)}")
+
+if __name__ == "__main__":
+    register_ptif_files()
+'''
+
 def get_pdf_page_count(pdf_path):
-    """Get the number of pages in a PDF file using pdfinfo."""
+    """Get the number of pages in a PDF file."""
+    if pdf_path not in _page_counts:
+        _page_counts[pdf_path] = _read_pdf_page_count(pdf_path)
+    return _page_counts[pdf_path]
+
+def _read_pdf_page_count(pdf_path):
+    """Read the number of pages of a PDF file.
+
+    The page count is read in-process with pyvips or pypdf, which only parse
+    the PDF header. pdfinfo is run only when neither is installed.
+    """
     try:
+        if pyvips is not None:
+            return pyvips.Image.pdfload(pdf_path).get('n-pages')
+        if PdfReader is not None:
+            return len(PdfReader(pdf_path, strict=False).pages)
         result = subprocess.run(['pdfinfo', pdf_path], capture_output=True, text=True)
         if result.returncode == 0:
             for line in result.stdout.splitlines():
@@ -32,12 +180,197 @@ def get_pdf_page_count(pdf_path):
                     return int(line.split(':')[1].strip())
         return 1  # Default to 1 if we can't determine
     except Exception as e:
-        print(f"Error getting PDF page count: {e}")
+        logger.error("Error getting PDF page count: %s", e)
         return 1
 
+def get_max_workers(page_count, limit=VIPS_SLOTS):
+    """Get the number of page conversions to run in parallel.
+
+    Capped so that the libvips pipelines, which are multithreaded themselves,
+    do not oversubscribe the machine.
+    """
+    return max(1, min(page_count, limit))
+
+def load_pdf_pages(pdf_path, dpi, page_count):
+    """Open the first ``page_count`` pages of a PDF as one vertical strip.
+
+    The PDF is parsed once, and each page is then rendered on demand when
+    its region of the strip is read. Returns ``None`` when the pages differ
+    in size: libvips then pads them to the widest page and leaves
+    ``page-height`` unset, so they have to be loaded one at a time.
+    """
+    pages = pyvips.Image.pdfload(pdf_path, dpi=dpi, page=0, n=page_count)
+    if pages.get_typeof("page-height") == 0:
+        return None
+    if pages.get("page-height") * page_count != pages.height:
+        return None
+    return pages
+
+def convert_page(args):
+    """Convert a single PDF page to a PTIF file.
+
+    Takes a ``(pages, pdf_path, dpi, output_path, page_num, tile_width,
+    tile_height)`` tuple, where ``pages`` is the strip returned by
+    ``load_pdf_pages``, so it can be used with ``Executor.map``, and returns
+    a ``(success, message)`` tuple. When ``pages`` is ``None`` the page is
+    loaded from ``pdf_path`` on its own.
+    """
+    pages, pdf_path, dpi, manual_file_path, page_num, tile_width, tile_height = args
+    messages = []
+    
+    # Cut the page out of the strip and save it as a PTIF (pyramidal TIFF) in
+    # a single in-process libvips pipeline, so no intermediate TIFF is written
+    messages.append(f"  Converting page {page_num} to PTIF")
+    try:
+        if pages is None:
+            image = pyvips.Image.pdfload(pdf_path, dpi=dpi, page=page_num - 1)
+        else:
+            page_height = pages.get("page-height")
+            image = pages.crop(
+                0, (page_num - 1) * page_height, pages.width, page_height
+            )
+        with _vips_slots:
+            image.tiffsave(
+                manual_file_path,
+                tile=True,
+                pyramid=True,
+                compression="jpeg",
+                tile_width=tile_width,
+                tile_height=tile_height,
+            )
+    except pyvips.Error as e:
+        messages.append(f"  ERROR: vips conversion failed: {e.message}: {e.detail}")
+        return False, "\n".join(messages)
+        
+    # Verify the output file exists
+    try:
+        file_size = os.stat(manual_file_path).st_size
+    except FileNotFoundError:
+        messages.append(f"  ERROR: Output file was not created: {manual_file_path}")
+        return False, "\n".join(messages)
+        
+    messages.append(f"  Successfully created PTIF file for page {page_num}: {manual_file_path}")
+    messages.append(f"  File size: {file_size} bytes")
+    return True, "\n".join(messages)
+
+def convert_pages_cli(pdf_path, pending_pages, dpi, tile_width, tile_height):
+    """Convert PDF pages to PTIF files with concurrent vips processes.
+
+    Used when pyvips is not available. Up to ``get_max_workers`` vips
+    processes run at a time; once the limit is reached the oldest one is
+    waited for before starting the next. Processes started for other PDFs
+    count towards the same limit. Returns a list of ``(success, message)``
+    tuples in page order.
+    """
+    max_parallel = get_max_workers(len(pending_pages))
+    inflight = deque()
+    results = []
+    
+    def wait_oldest():
+        process, manual_file_path, page_num, cmd = inflight.popleft()
+        try:
+            _, stderr = process.communicate()
+        finally:
+            _vips_slots.release()
+        message = f"  Running command (PDF page to PTIF): {' '.join(cmd)}"
+        if process.returncode != 0:
+            results.append((False, f"{message}\n  ERROR: vips tiffsave command failed: {stderr}"))
+            return
+        try:
+            file_size = os.stat(manual_file_path).st_size
+        except FileNotFoundError:
+            results.append((False, f"{message}\n  ERROR: Output file was not created: {manual_file_path}"))
+            return
+        # Successful pages are only logged at DEBUG level, skip building
+        # their message otherwise
+        if not logger.isEnabledFor(logging.DEBUG):
+            results.append((True, ""))
+            return
+        results.append((True, (
+            f"{message}\n"
+            f"  Successfully created PTIF file for page {page_num}: {manual_file_path}\n"
+            f"  File size: {file_size} bytes"
+        )))
+    
+    # The tiffsave options are the same for every page
+    tiffsave_opts = [
+        "--tile", "--pyramid", "--compression=jpeg",
+        f"--tile-width={tile_width}",
+        f"--tile-height={tile_height}"
+    ]
+    
+    for manual_file_path, page_num in pending_pages:
+        # Render the page and build the pyramid in a single vips process
+        # (page-1 because vips uses 0-indexed pages)
+        cmd = [
+            "vips", "tiffsave",
+            f"{pdf_path}[dpi={dpi},page={page_num-1}]",
+            manual_file_path,
+        ] + tiffsave_opts
+        # When other PDFs hold all the slots, free one of ours instead of
+        # blocking while our own processes are still running
+        while not _vips_slots.acquire(blocking=not inflight):
+            wait_oldest()
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        inflight.append((process, manual_file_path, page_num, cmd))
+        if len(inflight) >= max_parallel:
+            wait_oldest()
+    
+    while inflight:
+        wait_oldest()
+    return results
+
+def convert_pages(pdf_path, pending_pages, dpi, tile_width, tile_height):
+    """Convert PDF pages to PTIF files in parallel.
+
+    ``pending_pages`` is a list of ``(output_path, page_num)`` tuples. Returns
+    a list of ``(success, message)`` tuples in page order.
+    """
+    if pyvips is None:
+        return convert_pages_cli(
+            pdf_path, pending_pages, dpi, tile_width, tile_height
+        )
+    
+    # Open the PDF once for all the pages we convert, unless the pages
+    # differ in size
+    max_page = max(page_num for _, page_num in pending_pages)
+    pages = load_pdf_pages(pdf_path, dpi, max_page)
+    if pages is None:
+        logger.debug("  Pages of %s differ in size, loading them one by one", pdf_path)
+    
+    # Pages are independent, so convert them in parallel. libvips
+    # releases the GIL, so threads are enough
+    page_args = [
+        (pages, pdf_path, dpi, manual_file_path, page_num, tile_width, tile_height)
+        for manual_file_path, page_num in pending_pages
+    ]
+    max_workers = get_max_workers(len(page_args))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(convert_page, page_args))
+
+def collect_conversion(future):
+    """Wait for a ``convert_pages`` job and log its results.
+
+    Returns a ``(created, failed)`` tuple with the number of pages.
+    """
+    try:
+        results = future.result()
+    except Exception as e:
+        logger.exception("Error converting PDF pages: %s", e)
+        return 0, 1
+    
+    created = 0
+    for success, message in results:
+        logger.log(logging.DEBUG if success else logging.ERROR, message)
+        if success:
+            created += 1
+    return created, len(results) - created
+
 def create_multipage_pdf_ptif_files():
     """Create PTIF files for each page of PDF documents (read-only approach)."""
-    print("Starting multi-page PDF PTIF creation (read-only mode)...")
+    logger.info("Starting multi-page PDF PTIF creation (read-only mode)...")
     
     start_time = time.time()
     
@@ -48,117 +381,101 @@ def create_multipage_pdf_ptif_files():
     multi_page_pdfs = 0
     total_pdf_pages = 0
     ptif_files_created = 0
+    ptif_files_skipped = 0
     errors = 0
     
     with app.app_context():
         from invenio_rdm_records.records.api import RDMRecord
         
-        # Check for vips command availability
-        try:
-            result = subprocess.run(['vips', '--version'], capture_output=True, text=True)
-            if result.returncode == 0:
-                print(f"VIPS is available! Version: {result.stdout.strip()}")
-            else:
-                print("ERROR: vips command not found or error running it!")
+        if pyvips is not None:
+            # libvips is loaded when pyvips is imported, this is just a sanity check
+            logger.info("VIPS is available! Version: %s.%s.%s", pyvips.version(0), pyvips.version(1), pyvips.version(2))
+        else:
+            # Check for vips command availability
+            try:
+                result = subprocess.run(['vips', '--version'], capture_output=True, text=True)
+                if result.returncode == 0:
+                    logger.info("pyvips is not installed, using the vips command: %s", result.stdout.strip())
+                else:
+                    logger.error("pyvips is not installed and vips command not found or error running it!")
+                    return
+            except Exception as e:
+                logger.error("Failed to check vips availability: %s", e)
                 return
-        except Exception as e:
-            print(f"ERROR: Failed to check vips availability: {str(e)}")
-            return
         
-        # Check for pdfinfo command availability
-        try:
-            result = subprocess.run(['pdfinfo', '-v'], capture_output=True, text=True)
-            if result.returncode == 0:
-                print("pdfinfo is available!")
-            else:
-                print("ERROR: pdfinfo command not found. Install poppler-utils package!")
+        # pdfinfo is only needed to count pages when pyvips and pypdf are missing
+        if pyvips is None and PdfReader is None:
+            try:
+                result = subprocess.run(['pdfinfo', '-v'], capture_output=True, text=True)
+                if result.returncode == 0:
+                    logger.info("pdfinfo is available!")
+                else:
+                    logger.error("pdfinfo command not found. Install poppler-utils package!")
+                    return
+            except Exception as e:
+                logger.error("Failed to check pdfinfo availability: %s", e)
                 return
-        except Exception as e:
-            print(f"ERROR: Failed to check pdfinfo availability: {str(e)}")
-            return
         
         # Get IIIF configuration
         iiif_config = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
+        dpi = iiif_config.get('dpi', 300)
+        tile_width = iiif_config.get('tile_width', 512)
+        tile_height = iiif_config.get('tile_height', 512)
         storage_path = current_app.config.get(
             "IIIF_TILES_STORAGE_PATH",
             os.path.join(current_app.instance_path, "images")
         )
         
-        print(f"IIIF storage path: {storage_path}")
-        if not os.path.exists(storage_path):
-            os.makedirs(storage_path, exist_ok=True)
-            print(f"Created storage path: {storage_path}")
+        logger.info("IIIF storage path: %s", storage_path)
+        os.makedirs(storage_path, exist_ok=True)
         
         # Create an output directory for our manually created files
         manual_output_path = os.path.join(current_app.instance_path, "manual_ptif_files")
-        if not os.path.exists(manual_output_path):
-            os.makedirs(manual_output_path, exist_ok=True)
-            print(f"Created manual output path: {manual_output_path}")
+        os.makedirs(manual_output_path, exist_ok=True)
         
-        # Also create a file for registration commands
+        # Registration entries are written as JSON and read by a fixed loader script
         registration_script = os.path.join(manual_output_path, "register_ptif_files.py")
-        with open(registration_script, 'w') as f:
-            f.write('''#!/usr/bin/env python
-"""
-Script to register the manually created PTIF files.
-Run this script with:
-  source .venv/bin/activate && python register_ptif_files.py
-"""
-
-import os
-import sys
-from invenio_app.factory import create_api
-from invenio_db import db
-from invenio_files_rest.models import ObjectVersion
-from flask import current_app
-
-# Create Flask application
-app = create_api()
-
-def register_ptif_files():
-    """Register the manually created PTIF files."""
-    with app.app_context():
-        from invenio_rdm_records.records.api import RDMRecord
-        
-        # Add your registration commands below
-''')
+        registration_entries_file = os.path.join(manual_output_path, "register_ptif_files.json")
             
-        records = RDMRecord.model_cls.query.all()
-        total_records = len(records)
+        # Only records with media files enabled and a PDF file are loaded
+        query = media_pdf_records_query()
+        total_records = query.count()
         
-        print(f"Found {total_records} records to check")
+        logger.info("Found %s records with media files and PDF files to check", total_records)
         
-        # Keep track of registration commands
-        registration_commands = []
+        # Keep track of the PTIF files to register
+        registration_entries = []
         
-        for record_model in records:
+        # PDFs are converted in a thread pool while the scan goes on; threads
+        # only wait on libvips or vips processes, so the GIL is not an issue
+        pool = ThreadPoolExecutor(max_workers=PDF_WORKERS)
+        conversions = deque()
+        
+        # Stream record rows instead of loading them all in memory up front
+        for record_model in query.yield_per(CHUNK_SIZE):
             try:
                 # Load the record
                 record_id = str(record_model.id)
                 record = RDMRecord.get_record(record_model.id)
-                print(f"\nChecking record: {record_id}")
-                
-                # Check if media files are enabled
-                if not hasattr(record, 'media_files') or not record.media_files.enabled:
-                    print("  Media files not enabled")
-                    continue
+                logger.info("Checking record: %s", record_id)
                 
                 records_with_media_files += 1
                 
-                # Look for PDF files
-                for filename in record.files:
+                # Look for PDF files, reading the file keys once per record
+                files_list = list(record.files.keys())
+                for filename in files_list:
                     if filename.lower().endswith('.pdf'):
                         pdf_records += 1
-                        print(f"  Found PDF file: {filename}")
+                        logger.info("  Found PDF file: %s", filename)
                         
                         # Get original file to convert
                         original_file = record.files[filename]
                         original_file_uri = original_file.file.uri
-                        print(f"  Original file path: {original_file_uri}")
+                        logger.debug("  Original file path: %s", original_file_uri)
                         
                         # Get the number of pages
                         page_count = get_pdf_page_count(original_file_uri)
-                        print(f"  PDF has {page_count} pages")
+                        logger.debug("  PDF has %s pages", page_count)
                         total_pdf_pages += page_count
                         
                         if page_count > 1:
@@ -166,8 +483,7 @@ def register_ptif_files():
                         
                         # Process each page of the PDF
                         manual_record_dir = os.path.join(manual_output_path, record_id)
-                        if not os.path.exists(manual_record_dir):
-                            os.makedirs(manual_record_dir, exist_ok=True)
+                        os.makedirs(manual_record_dir, exist_ok=True)
                             
                         # Create a manifest file
                         manifest_path = os.path.join(manual_record_dir, f"{filename}.manifest.json")
@@ -179,144 +495,99 @@ def register_ptif_files():
                             "bucket_id": str(record.media_files.bucket_id)  # Convert UUID to string
                         }
                         
-                        # Add registration commands to the script
+                        # Add registration entries for each page
                         for page_num in range(1, page_count + 1):
                             page_ptif_filename = f"{filename}.page-{page_num}.ptif"
                             manual_file_path = os.path.join(manual_record_dir, page_ptif_filename)
-                            registration_command = f'''
-        # Register PTIF for {filename} page {page_num} from record {record_id}
-        record = RDMRecord.get_record("{record_id}")
-        if record and record.media_files.enabled:
-            page_ptif_filename = "{page_ptif_filename}"
-            manual_file_path = "{manual_file_path}"
-            
-            # Check if file already exists
-            if page_ptif_filename not in record.media_files:
-                try:
-                    # Create ObjectVersion for the new file
-                    print(f"Registering {{page_ptif_filename}} for record {record_id}")
-                    bucket_id = record.media_files.bucket_id
-                    obj = ObjectVersion.create(bucket_id, page_ptif_filename, stream=open(manual_file_path, 'rb'))
-                    db.session.add(obj)
-                    db.session.commit()
-                    
-                    # Add metadata to record
-                    obj_dict = {{
-                        "key": page_ptif_filename,
-                        "object_version_id": str(obj.version_id),
-                        "processor": {{
-                            "status": "finished",
-                            "pdf_page": {page_num},
-                            "pdf_total_pages": {page_count}
-                        }}
-                    }}
-                    record.media_files.add(obj_dict)
-                    record.commit()
-                    db.session.commit()
-                    print(f"Successfully registered {{page_ptif_filename}}")
-                except Exception as e:
-                    print(f"Error registering {{page_ptif_filename}}: {{str(e)}}")
-            else:
-                print(f"{{page_ptif_filename}} already exists in record {record_id}")
-'''
-                            registration_commands.append(registration_command)
+                            registration_entries.append({
+                                "record_id": record_id,
+                                "filename": filename,
+                                "page_num": page_num,
+                                "page_ptif_filename": page_ptif_filename,
+                                "manual_file_path": manual_file_path,
+                                "page_count": page_count
+                            })
                         
                         # Write the manifest file
                         with open(manifest_path, 'w') as f:
                             json.dump(manifest_data, f, indent=2)
                         
-                        print(f"  Created manifest file at {manifest_path}")
+                        logger.debug("  Created manifest file at %s", manifest_path)
                         
                         # Process only a few pages for testing if the PDF is large
                         max_pages_to_process = min(page_count, 10) if page_count > 20 else page_count
-                        print(f"  Will process {max_pages_to_process} pages out of {page_count}")
+                        logger.debug("  Will process %s pages out of %s", max_pages_to_process, page_count)
                         
+                        pending_pages = []
                         for page_num in range(1, max_pages_to_process + 1):
                             page_ptif_filename = f"{filename}.page-{page_num}.ptif"
-                            print(f"  Processing page {page_num}/{page_count}: {page_ptif_filename}")
                             
                             # Save the page PTIF file to our manual directory
                             manual_file_path = os.path.join(manual_record_dir, page_ptif_filename)
                             
-                            # First convert PDF page to temporary TIFF
-                            temp_tiff = f"{manual_file_path}.temp.tiff"
-                            
-                            # Command to extract and convert a specific page (page-1 means 0-indexed)
-                            cmd1 = [
-                                "vips", "pdfload", original_file_uri,
-                                temp_tiff,
-                                f"--dpi={iiif_config.get('dpi', 300)}",
-                                f"--page={page_num-1}"  # vips uses 0-indexed pages
-                            ]
-                            print(f"  Running command (PDF page to TIFF): {' '.join(cmd1)}")
-                            result1 = subprocess.run(cmd1, capture_output=True, text=True)
-                            
-                            if result1.returncode != 0:
-                                print(f"  ERROR: vips pdfload command failed: {result1.stderr}")
-                                errors += 1
+                            # Skip pages already converted by a previous run
+                            if is_up_to_date(manual_file_path, original_file_uri):
+                                logger.debug("  Skipping page %s/%s, %s is up to date", page_num, page_count, page_ptif_filename)
+                                ptif_files_skipped += 1
                                 continue
                             
-                            # Convert TIFF to PTIF (pyramidal TIFF)
-                            cmd2 = [
-                                "vips", "tiffsave", temp_tiff,
-                                manual_file_path,
-                                "--tile", "--pyramid", "--compression=jpeg",
-                                f"--tile-width={iiif_config.get('tile_width', 512)}",
-                                f"--tile-height={iiif_config.get('tile_height', 512)}"
-                            ]
-                            print(f"  Running command (TIFF to PTIF): {' '.join(cmd2)}")
-                            result2 = subprocess.run(cmd2, capture_output=True, text=True)
-                            
-                            # Clean up temp file
-                            if os.path.exists(temp_tiff):
-                                os.remove(temp_tiff)
-                            
-                            if result2.returncode != 0:
-                                print(f"  ERROR: vips tiffsave command failed: {result2.stderr}")
-                                errors += 1
-                                continue
-                                
-                            # Verify the output file exists
-                            if not os.path.exists(manual_file_path):
-                                print(f"  ERROR: Output file was not created: {manual_file_path}")
-                                errors += 1
-                                continue
-                                
-                            print(f"  Successfully created PTIF file for page {page_num}: {manual_file_path}")
-                            print(f"  File size: {os.path.getsize(manual_file_path)} bytes")
-                            ptif_files_created += 1
+                            logger.debug("  Processing page %s/%s: %s", page_num, page_count, page_ptif_filename)
+                            pending_pages.append((manual_file_path, page_num))
+                        
+                        if not pending_pages:
+                            continue
+                        
+                        # Convert in the background and move on to the next PDF
+                        conversions.append(pool.submit(
+                            convert_pages,
+                            original_file_uri,
+                            pending_pages,
+                            dpi,
+                            tile_width,
+                            tile_height,
+                        ))
+                        
+                        # Keep a bounded number of PDFs waiting for conversion
+                        while len(conversions) >= 2 * PDF_WORKERS:
+                            created, failed = collect_conversion(conversions.popleft())
+                            ptif_files_created += created
+                            errors += failed
                 
             except Exception as e:
-                print(f"Error processing record {record_id}: {str(e)}")
-                traceback.print_exc()
+                logger.exception("Error processing record %s: %s", record_id, e)
                 errors += 1
         
-        # Write registration commands to the script
-        with open(registration_script, 'a') as f:
-            for cmd in registration_commands:
-                f.write(cmd)
-            
-            # Add main call
-            f.write('''
-if __name__ == "__main__":
-    register_ptif_files()
-''')
+        # Wait for the remaining conversions
+        while conversions:
+            created, failed = collect_conversion(conversions.popleft())
+            ptif_files_created += created
+            errors += failed
+        pool.shutdown()
+        
+        # Write registration entries and the loader script
+        with open(registration_entries_file, 'w') as f:
+            json.dump(registration_entries, f, indent=2)
+        
+        with open(registration_script, 'w') as f:
+            f.write(REGISTRATION_SCRIPT)
         
-        print(f"\nCreated registration script: {registration_script}")
-        print("You can run this script later to register the PTIF files with the records.")
+        logger.info("Created registration entries: %s", registration_entries_file)
+        logger.info("Created registration script: %s", registration_script)
+        logger.info("You can run this script later to register the PTIF files with the records.")
     
     elapsed_time = time.time() - start_time
     
-    print("\n===== Multi-page PDF PTIF Creation Summary =====")
-    print(f"Total records: {total_records}")
-    print(f"Records with media files enabled: {records_with_media_files}")
-    print(f"Records with PDF files: {pdf_records}")
-    print(f"Multi-page PDFs found: {multi_page_pdfs}")
-    print(f"Total PDF pages processed: {total_pdf_pages}")
-    print(f"PTIF files created: {ptif_files_created}")
-    print(f"Errors encountered: {errors}")
-    print(f"Elapsed time: {elapsed_time:.2f} seconds")
-    print("===============================================")
+    logger.info("===== Multi-page PDF PTIF Creation Summary =====")
+    logger.info("Records checked: %s", total_records)
+    logger.info("Records with media files enabled: %s", records_with_media_files)
+    logger.info("Records with PDF files: %s", pdf_records)
+    logger.info("Multi-page PDFs found: %s", multi_page_pdfs)
+    logger.info("Total PDF pages processed: %s", total_pdf_pages)
+    logger.info("PTIF files created: %s", ptif_files_created)
+    logger.info("PTIF files skipped (up to date): %s", ptif_files_skipped)
+    logger.info("Errors encountered: %s", errors)
+    logger.info("Elapsed time: %.2f seconds", elapsed_time)
+    logger.info("===============================================")
 
 if __name__ == "__main__":
     create_multipage_pdf_ptif_files() 
\ No newline at end of file
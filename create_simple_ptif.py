@@ -4,27 +4,38 @@ Script to create a simple PTIF file for a PDF.
 This will create a PTIF file for the first page of a PDF only.
 
 Run this script with:
-  source .venv/bin/activate && python create_simple_ptif.py
+  source .venv/bin/activate && python create_simple_ptif.py [--verbose]
 """
 
 import os
-import sys
 import json
-import subprocess
 import shutil
+import pyvips
 from invenio_app.factory import create_api
 from invenio_db import db
 from invenio_files_rest.models import ObjectVersion
 from flask import current_app
+from ptif_utils import setup_logging
 
 # Create Flask application
 app = create_api()
 
+# Conversion details are logged at DEBUG level, run with --verbose to see them
+logger = setup_logging(__name__)
+
 def create_simple_ptif():
     """Create a simple PTIF file for PDFs."""
     with app.app_context():
         from invenio_rdm_records.records.api import RDMRecord
         
+        # Get DPI from config
+        iiif_config = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
+        dpi = iiif_config.get("dpi", 300)
+        
+        # Create temporary directory for processing
+        temp_dir = os.path.join(current_app.instance_path, "temp_ptif_files")
+        os.makedirs(temp_dir, exist_ok=True)
+        
         # Record IDs with PDF files
         record_ids = [
             "b8902cb3-eaaf-4201-89c6-f6475085c0c3",
@@ -35,22 +46,22 @@ def create_simple_ptif():
             try:
                 record = RDMRecord.get_record(record_id)
                 if not record or not record.media_files.enabled:
-                    print(f"Record {record_id} does not exist or media files not enabled")
+                    logger.info("Record %s does not exist or media files not enabled", record_id)
                     continue
                 
                 # Check for PDF files in the record
                 pdf_files = [f for f in record.files.keys() if f.lower().endswith('.pdf')]
                 if not pdf_files:
-                    print(f"No PDF files found in record {record_id}")
+                    logger.info("No PDF files found in record %s", record_id)
                     continue
                 
                 for pdf_filename in pdf_files:
-                    print(f"Processing {pdf_filename} from record {record_id}")
+                    logger.info("Processing %s from record %s", pdf_filename, record_id)
                     
                     # Check if the PTIF file already exists
                     ptif_filename = f"{pdf_filename}.ptif"
                     if ptif_filename in record.media_files:
-                        print(f"{ptif_filename} already exists in record {record_id}")
+                        logger.info("%s already exists in record %s", ptif_filename, record_id)
                         continue
                     
                     # Original PDF file path
@@ -58,48 +69,41 @@ def create_simple_ptif():
                     pdf_obj = record.files.get_file_object(pdf_filename)
                     pdf_path = pdf_obj.file.uri
                     
-                    # Create temporary directory for processing
-                    temp_dir = os.path.join(current_app.instance_path, "temp_ptif_files")
-                    os.makedirs(temp_dir, exist_ok=True)
-                    
-                    # Output file paths
-                    temp_tiff_path = os.path.join(temp_dir, f"{pdf_filename}.temp.tiff")
+                    # Output file path
                     ptif_path = os.path.join(temp_dir, ptif_filename)
                     
-                    # Get DPI from config
-                    iiif_config = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
-                    dpi = iiif_config.get("dpi", 300)
-                    
                     try:
-                        # Command to convert PDF to TIFF
-                        cmd1 = [
-                            "vips", "pdfload", pdf_path, temp_tiff_path,
-                            f"--dpi={dpi}", "--page=0"  # Only convert first page
-                        ]
-                        
-                        # Command to convert TIFF to PTIF
-                        cmd2 = [
-                            "vips", "tiffsave", temp_tiff_path, ptif_path,
-                            "--tile", "--pyramid", "--compression=jpeg",
-                            "--tile-width=256", "--tile-height=256"
-                        ]
-                        
-                        # Execute commands
-                        print(f"Running command: {' '.join(cmd1)}")
-                        result1 = subprocess.run(cmd1, check=True, capture_output=True, text=True)
-                        
-                        print(f"Running command: {' '.join(cmd2)}")
-                        result2 = subprocess.run(cmd2, check=True, capture_output=True, text=True)
+                        # Convert the PDF (first page only) to PTIF in a single
+                        # in-process libvips pipeline, without an intermediate TIFF
+                        logger.debug("Converting %s to %s", pdf_path, ptif_path)
+                        image = pyvips.Image.pdfload(
+                            pdf_path, dpi=dpi, page=0, access="sequential"
+                        )
+                        image.tiffsave(
+                            ptif_path,
+                            tile=True,
+                            pyramid=True,
+                            compression="jpeg",
+                            tile_width=256,
+                            tile_height=256,
+                        )
                         
                         # Check if PTIF file was created successfully
-                        if os.path.exists(ptif_path) and os.path.getsize(ptif_path) > 0:
-                            print(f"PTIF file created successfully: {ptif_path}")
-                            print(f"PTIF file size: {os.path.getsize(ptif_path)} bytes")
+                        try:
+                            ptif_size = os.stat(ptif_path).st_size
+                        except FileNotFoundError:
+                            ptif_size = 0
+                        if ptif_size > 0:
+                            logger.debug("PTIF file created successfully: %s", ptif_path)
+                            logger.debug("PTIF file size: %s bytes", ptif_size)
                             
                             # Create ObjectVersion for the new file
                             bucket_id = record.media_files.bucket_id
-                            with open(ptif_path, 'rb') as ptif_file:
-                                obj = ObjectVersion.create(bucket_id, ptif_filename, stream=ptif_file)
+                            with open(ptif_path, 'rb', buffering=1 << 20) as ptif_file:
+                                obj = ObjectVersion.create(
+                                    bucket_id, ptif_filename, stream=ptif_file,
+                                    size=ptif_size
+                                )
                                 db.session.add(obj)
                                 db.session.commit()
                             
@@ -114,27 +118,27 @@ def create_simple_ptif():
                             record.media_files.add(obj_dict)
                             record.commit()
                             db.session.commit()
-                            print(f"Successfully registered {ptif_filename} for record {record_id}")
+                            logger.info("Successfully registered %s for record %s", ptif_filename, record_id)
                         else:
-                            print(f"Failed to create PTIF file for {pdf_filename}")
+                            logger.error("Failed to create PTIF file for %s", pdf_filename)
                             
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error converting {pdf_filename}: {e}")
-                        print(f"Command output: {e.stdout}")
-                        print(f"Command error: {e.stderr}")
+                    except pyvips.Error as e:
+                        logger.error("Error converting %s: %s", pdf_filename, e.message)
+                        logger.error("libvips error: %s", e.detail)
                     
                     except Exception as e:
-                        print(f"Error processing {pdf_filename}: {str(e)}")
+                        logger.error("Error processing %s: %s", pdf_filename, e)
                     
                     finally:
-                        # Clean up temporary files
-                        for temp_file in [temp_tiff_path, ptif_path]:
-                            if os.path.exists(temp_file):
-                                os.remove(temp_file)
-                                print(f"Removed temporary file: {temp_file}")
+                        # Clean up the temporary file
+                        try:
+                            os.remove(ptif_path)
+                            logger.debug("Removed temporary file: %s", ptif_path)
+                        except FileNotFoundError:
+                            pass
             
             except Exception as e:
-                print(f"Error processing record {record_id}: {str(e)}")
+                logger.error("Error processing record %s: %s", record_id, e)
 
 if __name__ == "__main__":
     create_simple_ptif() 
\ No newline at end of file
@@ -7,12 +7,9 @@ import io
 import os
 import sys
 from pathlib import Path
-from invenio_app.factory import create_api
 from invenio_rdm_records.services.iiif.storage import LocalTilesStorage
 from invenio_rdm_records.services.iiif.converter import HAS_VIPS
-
-# Create Flask application
-app = create_api()
+from ptif_utils import get_app
 
 class MockFileRecord:
     """Mock file record for testing."""
@@ -60,9 +57,18 @@ class MockRecord:
         """Get files."""
         return self._files
 
+def find_ptif_files(root):
+    """Yield ``(path, size)`` for the PTIF files below ``root``."""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_ptif_files(entry.path)
+            elif entry.name.endswith('.ptif'):
+                yield entry.path, entry.stat().st_size
+
 def test_tiles_storage():
     """Test the LocalTilesStorage directly."""
-    with app.app_context():
+    with get_app().app_context():
         from flask import current_app
         
         # Print configuration
@@ -118,16 +124,13 @@ def test_tiles_storage():
             
             if os.path.exists(expected_path):
                 print(f"Output directory exists")
-                # Check if any files were created in the output directory
-                files_found = False
-                for root, dirs, files in os.walk(expected_path):
-                    for file in files:
-                        if file.endswith('.ptif'):
-                            path = os.path.join(root, file)
-                            print(f"Found file: {path} (size: {os.path.getsize(path)} bytes)")
-                            files_found = True
-                
-                if not files_found:
+                # Check if any files were created in the output directory, the
+                # first one found is enough
+                found = next(find_ptif_files(expected_path), None)
+                if found:
+                    path, size = found
+                    print(f"Found file: {path} (size: {size} bytes)")
+                else:
                     print("No .ptif files found in the output directory")
             else:
                 print(f"Output directory was not created")
@@ -1,20 +1,26 @@
 #!/usr/bin/env python
 """
 Debug script to test the IIIF tile generation functionality.
+Run this script with --verbose to also dump the converter's attributes and
+the source of its convert method.
 """
 
-import io
 import os
 import sys
-from invenio_app.factory import create_api
+import time
+from ptif_utils import get_app
+
+# libvips reads its thread count when it is first loaded, which happens when
+# the converter module imports pyvips
+os.environ.setdefault("VIPS_CONCURRENCY", str(os.cpu_count() or 1))
+
 from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter, HAS_VIPS
 
-# Create Flask application
-app = create_api()
+VERBOSE = "--verbose" in sys.argv
 
 def test_image_conversion():
     """Test the basic image conversion functionality."""
-    with app.app_context():
+    with get_app().app_context():
         from flask import current_app
         
         # Print configuration
@@ -27,6 +33,13 @@ def test_image_conversion():
             import pyvips
             print(f"Imported pyvips module: {pyvips}")
             print(f"pyvips.__version__: {pyvips.__version__}")
+            
+            # Keep operations of the pyramid build cached across resolutions
+            pyvips.cache_set_max(500)
+            pyvips.cache_set_max_mem(200 * 1024 * 1024)
+            pyvips.leak_set(False)
+            print(f"VIPS_CONCURRENCY: {os.environ['VIPS_CONCURRENCY']}")
+            print(f"libvips save suffixes: {pyvips.get_suffixes()}")
         except ImportError as e:
             print(f"Failed to import pyvips: {e}")
         except Exception as e:
@@ -39,15 +52,20 @@ def test_image_conversion():
         converter_params = current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
         converter = PyVIPSImageConverter(params=converter_params)
         
-        # Print converter attributes
-        print("\nConverter attributes:")
-        for attr in dir(converter):
-            if not attr.startswith('__'):
-                try:
-                    value = getattr(converter, attr)
-                    print(f"  {attr}: {value}")
-                except Exception as e:
-                    print(f"  {attr}: Error getting value - {e}")
+        # Print converter attributes and source, reading every attribute can
+        # trigger lazy properties so this is only done on request
+        if VERBOSE:
+            print("\nConverter attributes:")
+            for attr in dir(converter):
+                if not attr.startswith('__'):
+                    try:
+                        value = getattr(converter, attr)
+                        print(f"  {attr}: {value}")
+                    except Exception as e:
+                        print(f"  {attr}: Error getting value - {e}")
+            
+            import inspect
+            print(f"\nConvert method source:\n{inspect.getsource(converter.convert)}")
         
         # Create test image path
         test_image = 'test.tif'
@@ -59,18 +77,12 @@ def test_image_conversion():
         output_path = os.path.join(current_app.instance_path, 'test_output.ptif')
         print(f"\nConverting image {test_image} to {output_path}")
         
-        # Test conversion
+        # Test conversion through the converter invenio uses
         try:
+            start = time.perf_counter()
             with open(test_image, 'rb') as fin, open(output_path, 'wb') as fout:
-                # Debug the convert method
-                print("\nDebugging convert method:")
-                import inspect
-                convert_source = inspect.getsource(converter.convert)
-                print(f"Convert method source:\n{convert_source}")
-                
-                # Test if we get into the convert method
                 result = converter.convert(fin, fout)
-                print(f"Conversion result: {result}")
+            print(f"Conversion result: {result} ({time.perf_counter() - start:.2f} seconds)")
                 
             # Check if file was created
             if os.path.exists(output_path):
@@ -79,6 +91,25 @@ def test_image_conversion():
                 print("Output file was not created!")
         except Exception as e:
             print(f"Error during conversion: {e}")
+        
+        # For comparison, let libvips stream the image from disk and write
+        # the pyramid directly, without calling back into Python for reads
+        # and writes
+        native_output_path = os.path.join(current_app.instance_path, 'test_output_native.ptif')
+        print(f"\nConverting image {test_image} to {native_output_path} with native streams")
+        try:
+            import pyvips
+            print(f"pyvips API mode: {pyvips.API_mode}")
+            
+            start = time.perf_counter()
+            source = pyvips.Source.new_from_file(test_image)
+            target = pyvips.Target.new_to_file(native_output_path)
+            image = pyvips.Image.new_from_source(source, "", access="sequential")
+            image.tiffsave_target(target, tile=True, pyramid=True, **converter_params)
+            print(f"Native conversion took {time.perf_counter() - start:.2f} seconds")
+            print(f"Output file size: {os.path.getsize(native_output_path)} bytes")
+        except Exception as e:
+            print(f"Error during native conversion: {e}")
 
 if __name__ == "__main__":
     test_image_conversion() 
\ No newline at end of file
@@ -2,15 +2,15 @@
 """
 Improved script to generate IIIF tiles for existing files.
 Run this script with:
-  source .venv/bin/activate && python fix_process_iiif_tiles.py
+  source .venv/bin/activate && python fix_process_iiif_tiles.py [--verbose]
 """
 
 import os
-import sys
 import time
 import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from invenio_app.factory import create_api
 from invenio_db import db
 from invenio_rdm_records.proxies import current_rdm_records_service
 from invenio_rdm_records.records.api import RDMRecord
@@ -18,9 +18,109 @@ from invenio_rdm_records.records.processors.tiles import TilesProcessor
 from invenio_records_resources.services.files.processors.image import ImageMetadataExtractor
 from invenio_records_resources.services.uow import UnitOfWork, RecordCommitOp
 from flask import current_app
+from ptif_utils import get_app, setup_logging
 
-# Create Flask application
-app = create_api()
+# Per-record details are logged at DEBUG level, run with --verbose to see them
+logger = setup_logging(__name__)
+
+# Number of record IDs fetched from the database at a time
+CHUNK_SIZE = 500
+
+# Number of processes generating tiles and libvips threads in each of them,
+# so that all workers together roughly match the number of cores
+NUM_WORKERS = min(os.cpu_count() or 1, 4)
+VIPS_THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // NUM_WORKERS)
+
+# Images this large (in pixels, either dimension) get bigger PTIF tiles, so
+# fewer tiles have to be encoded and written
+LARGE_IMAGE_SIZE = 20000
+LARGE_TILE_SIZE = 4096
+
+# File in the instance path recording the libvips version that passed the
+# test conversion, so the test is only run again after libvips changes
+PROBE_SENTINEL = ".iiif_probe_ok"
+
+def _init_worker():
+    """Set up a tile generation process with its own application context."""
+    import pyvips
+    
+    # Keep operations of the pyramid build cached across resolutions, the
+    # thread count is capped by VIPS_CONCURRENCY set by the driver
+    pyvips.cache_set_max(500)
+    pyvips.cache_set_max_mem(200 * 1024 * 1024)
+    pyvips.leak_set(False)
+    get_app().app_context().push()
+
+def pick_tile_size(path):
+    """Pick the PTIF tile size of an image from its dimensions.
+
+    Only the image header is read. Returns ``LARGE_TILE_SIZE`` for large
+    images, or ``None`` to keep the configured tile size.
+    """
+    import pyvips
+    
+    try:
+        probe = pyvips.Image.new_from_file(path, access="sequential")
+    except pyvips.Error:
+        return None
+    if max(probe.width, probe.height) >= LARGE_IMAGE_SIZE:
+        return LARGE_TILE_SIZE
+    return None
+
+def convert_with_tile_size(pid_value, file_key, tile_size):
+    """Write the PTIF of a file with ``tile_size`` tiles and mark it finished.
+
+    generate_tiles uses the converter its module builds at import time, so
+    the tile size cannot be changed for it. This does the same conversion
+    with a converter of its own instead.
+    """
+    from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter
+    from invenio_rdm_records.services.iiif.storage import LocalTilesStorage
+    
+    converter = PyVIPSImageConverter(params={
+        **current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {}),
+        "tile_width": tile_size,
+        "tile_height": tile_size,
+    })
+    storage = LocalTilesStorage(base_path=os.path.join(
+        current_app.instance_path,
+        current_app.config.get("IIIF_TILES_STORAGE_BASE_PATH", "images/")
+    ))
+    
+    record = RDMRecord.pid.resolve(pid_value)
+    ptif_key = f"{file_key}.ptif"
+    tiles_path = storage._get_file_path(record, ptif_key)
+    os.makedirs(os.path.dirname(tiles_path), exist_ok=True)
+    with record.files[file_key].open_stream("rb") as fin, open(tiles_path, "wb") as fout:
+        if not converter.convert(fin, fout):
+            raise RuntimeError(f"Conversion of {file_key} to {tiles_path} failed")
+    
+    if ptif_key in record.media_files:
+        media_file = record.media_files[ptif_key]
+        media_file.processor["status"] = "finished"
+        media_file.commit()
+    db.session.commit()
+
+def _convert_one(work_item):
+    """Generate the IIIF tiles of a single file.
+
+    Runs in a worker process. Takes a ``(pid_value, file_key, tile_size)``
+    tuple and returns a ``(pid_value, file_key, success, error)`` tuple. When
+    ``tile_size`` is set, the file is converted with that tile size by
+    ``convert_with_tile_size`` instead of the generate_tiles task.
+    """
+    from invenio_rdm_records.services.iiif.tasks import generate_tiles
+    
+    pid_value, file_key, tile_size = work_item
+    try:
+        if tile_size:
+            convert_with_tile_size(pid_value, file_key, tile_size)
+        else:
+            generate_tiles(pid_value, file_key, "files")
+        return pid_value, file_key, True, None
+    except Exception as e:
+        db.session.rollback()
+        return pid_value, file_key, False, str(e)
 
 def check_iiif_configuration():
     """Check the IIIF configuration."""
@@ -34,6 +134,7 @@ def check_iiif_configuration():
     try:
         import pyvips
         print(f"PyVIPS version: {pyvips.__version__}")
+        logger.debug("libvips save suffixes: %s", pyvips.get_suffixes())
         
         from invenio_rdm_records.services.iiif.converter import HAS_VIPS
         print(f"HAS_VIPS: {HAS_VIPS}")
@@ -62,24 +163,32 @@ def check_iiif_configuration():
     else:
         print(f"IIIF storage path exists.")
     
+    # Skip the test conversion if it already passed with this libvips version
+    probe_key = f"{pyvips.version(0)}.{pyvips.version(1)}.{pyvips.version(2)}"
+    probe_sentinel = os.path.join(current_app.instance_path, PROBE_SENTINEL)
+    try:
+        with open(probe_sentinel) as f:
+            if f.read() == probe_key:
+                print(f"Conversion test already passed with libvips {probe_key}, skipping it.")
+                return True
+    except FileNotFoundError:
+        pass
+    
     # Test simple image conversion
     try:
         print("\nTesting IIIF tile generation with a simple image...")
-        from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter
         
-        # Create a simple test image if it doesn't exist
-        import numpy as np
-        from PIL import Image
+        # Create a simple 100x100 grayscale test image with libvips
         test_image_path = "test_vips.tif"
+        test_image = pyvips.Image.black(100, 100).draw_rect(
+            255, 25, 25, 50, 50, fill=True  # White square in center
+        )
+        test_image.tiffsave(test_image_path)
+        print(f"Created test image: {test_image_path}")
         
-        if not os.path.exists(test_image_path):
-            # Create a simple 100x100 grayscale image
-            test_img = np.zeros((100, 100), dtype=np.uint8)
-            test_img[25:75, 25:75] = 255  # White square in center
-            Image.fromarray(test_img).save(test_image_path)
-            print(f"Created test image: {test_image_path}")
+        # Test basic conversion with the converter invenio uses
+        from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter
         
-        # Test basic conversion
         test_output_path = os.path.join(current_app.instance_path, "test_output.ptif")
         converter = PyVIPSImageConverter(
             params=current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
@@ -89,8 +198,10 @@ def check_iiif_configuration():
             result = converter.convert(fin, fout)
             print(f"Basic conversion test result: {result}")
         
-        if os.path.exists(test_output_path) and os.path.getsize(test_output_path) > 0:
+        if result and os.path.exists(test_output_path) and os.path.getsize(test_output_path) > 0:
             print(f"Test successful: Created {test_output_path} ({os.path.getsize(test_output_path)} bytes)")
+            with open(probe_sentinel, 'w') as f:
+                f.write(probe_key)
             return True
         else:
             print("Test failed: Could not create PTIF file")
@@ -100,6 +211,24 @@ def check_iiif_configuration():
         traceback.print_exc()
         return False
 
+def iter_record_ids(chunk_size=CHUNK_SIZE):
+    """Yield all record IDs, fetching them one chunk at a time.
+
+    Uses keyset pagination instead of a streaming cursor, because records
+    are committed while iterating and a commit would close the cursor.
+    """
+    model_cls = RDMRecord.model_cls
+    last_id = None
+    while True:
+        query = db.session.query(model_cls.id).order_by(model_cls.id)
+        if last_id is not None:
+            query = query.filter(model_cls.id > last_id)
+        ids = [row.id for row in query.limit(chunk_size)]
+        if not ids:
+            return
+        yield from ids
+        last_id = ids[-1]
+
 def generate_iiif_tiles_for_all_records():
     """Generate IIIF tiles for all records."""
     # First check the configuration
@@ -107,19 +236,19 @@ def generate_iiif_tiles_for_all_records():
         print("\nIIIF configuration check failed! Please fix the issues before continuing.")
         return False
     
-    print("\nStarting IIIF tile generation for all records...")
+    logger.info("Starting IIIF tile generation for all records...")
     
-    # Get all records
-    records = RDMRecord.model_cls.query.all()
-    print(f"Found {len(records)} records")
+    # Count the records, they are streamed one chunk at a time below
+    total_records = RDMRecord.model_cls.query.count()
+    logger.info("Found %s records", total_records)
     
     # Create processors
     processor = TilesProcessor()
     image_metadata_extractor = ImageMetadataExtractor()
     
     # Count statistics
-    total_records = len(records)
     processed_records = 0
+    skipped_records = 0
     successful_records = 0
     failed_records = 0
     files_processed = 0
@@ -128,92 +257,131 @@ def generate_iiif_tiles_for_all_records():
     # Track the time
     start_time = time.time()
     
+    # Read the configuration once instead of for every file, as a tuple of
+    # suffixes for str.endswith
+    valid_suffixes = tuple(
+        f".{ext.lower()}" for ext in current_app.config.get("IIIF_TILES_VALID_EXTENSIONS", [])
+    )
+    
+    # Files that need tiles, as (pid_value, file_key, tile_size) tuples
+    worklist = []
+    committed_records = []
+    
     # Process each record
-    for record_model in records:
+    for record_id in iter_record_ids():
         try:
-            record_uuid = str(record_model.id)
+            record_uuid = str(record_id)
             
             with UnitOfWork() as uow:
-                record = RDMRecord.get_record(record_model.id)
-                print(f"\nProcessing record {record.pid.pid_value} ({record_uuid})")
-                print(f"Files: {list(record.files.keys())}")
+                record = RDMRecord.get_record(record_id)
+                logger.info("Processing record %s (%s)", record.pid.pid_value, record_uuid)
+                logger.debug("Files: %s", list(record.files.keys()))
                 
                 # Check if media files are enabled
                 if not hasattr(record, 'media_files'):
-                    print(f"Record has no media_files attribute!")
+                    logger.info("Record has no media_files attribute!")
                     failed_records += 1
                     continue
                     
                 if not record.media_files.enabled:
-                    print(f"Media files are not enabled for this record.")
+                    logger.info("Media files are not enabled for this record.")
                     failed_records += 1
                     continue
                 
-                print(f"Media files enabled: {record.media_files.enabled}")
+                logger.debug("Media files enabled: %s", record.media_files.enabled)
+                
+                # Only files with a valid extension need metadata and tiles,
+                # other files are never loaded
+                image_keys = [
+                    file_key for file_key in record.files
+                    if file_key.lower().endswith(valid_suffixes)
+                ]
+                if not image_keys:
+                    logger.debug("No files with a valid IIIF extension, skipping record")
+                    skipped_records += 1
+                    continue
                 
                 # Call the processor on the record
                 processor(None, record, uow=uow)
                 uow.register(RecordCommitOp(record))
                 
                 # Process files
-                record_success = False
-                
-                for file_key in record.files.keys():
+                for file_key in image_keys:
                     file_record = record.files[file_key]
-                    print(f"Processing file {file_key}")
+                    logger.debug("Processing file %s", file_key)
                     files_processed += 1
                     
                     # Extract metadata for images
                     if image_metadata_extractor.can_process(file_record):
-                        print(f"Extracting metadata for {file_key}")
+                        logger.debug("Extracting metadata for %s", file_key)
                         image_metadata_extractor.process(file_record)
                         file_record.commit()
                     
                     # Generate IIIF tiles for supported file types
-                    file_ext = os.path.splitext(file_key)[1].lower()[1:]
-                    valid_extensions = current_app.config.get("IIIF_TILES_VALID_EXTENSIONS", [])
+                    logger.debug("Generating IIIF tiles for %s", file_key)
                     
-                    if file_ext in valid_extensions:
-                        print(f"Generating IIIF tiles for {file_key}")
-                        # Check if ptif file already exists
-                        ptif_key = f"{file_key}.ptif"
+                    # Check if ptif file already exists
+                    ptif_key = f"{file_key}.ptif"
+                    
+                    if ptif_key in record.media_files:
+                        logger.debug("PTIF file already exists in media_files")
+                        
+                        # Check the status
+                        status = record.media_files[ptif_key].processor.get("status", "unknown")
+                        logger.debug("Status: %s", status)
                         
-                        if ptif_key in record.media_files:
-                            print(f"PTIF file already exists in media_files")
-                            
-                            # Check the status
-                            status = record.media_files[ptif_key].processor.get("status", "unknown")
-                            print(f"Status: {status}")
-                            
-                            # Regenerate if failed
-                            if status == "failed":
-                                print(f"Previous generation failed, retrying...")
-                                from invenio_rdm_records.services.iiif.tasks import generate_tiles
-                                generate_tiles(record.pid.pid_value, file_key, "files")
-                                print(f"Regenerated tiles for {file_key}")
-                                files_converted += 1
-                                record_success = True
-                        else:
-                            print(f"Creating new PTIF file for {file_key}")
-                            # Manually generate tiles for this file
-                            from invenio_rdm_records.services.iiif.tasks import generate_tiles
-                            generate_tiles(record.pid.pid_value, file_key, "files")
-                            print(f"Generated tiles for {file_key}")
-                            files_converted += 1
-                            record_success = True
+                        # Regenerate if failed
+                        if status == "failed":
+                            logger.debug("Previous generation failed, queued for retry")
+                            worklist.append((
+                                record.pid.pid_value,
+                                file_key,
+                                pick_tile_size(file_record.file.uri),
+                            ))
+                    else:
+                        logger.debug("Queued new PTIF file for %s", file_key)
+                        worklist.append((
+                            record.pid.pid_value,
+                            file_key,
+                            pick_tile_size(file_record.file.uri),
+                        ))
                 
                 uow.commit()
-                print(f"Committed record {record_uuid}")
+                logger.debug("Committed record %s", record_uuid)
                 processed_records += 1
-                
-                if record_success:
-                    successful_records += 1
-                else:
-                    failed_records += 1
+                committed_records.append(record.pid.pid_value)
                     
         except Exception as e:
-            print(f"Error processing record {record_model.id}: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Error processing record %s: %s", record_id, e)
+            failed_records += 1
+    
+    # Generate the tiles in parallel, each file is converted independently.
+    # Worker processes are spawned so they start with a fresh libvips and
+    # database connection, and their libvips threads are capped so that
+    # all workers together roughly match the number of cores
+    logger.info("Generating tiles for %s files with %s processes...", len(worklist), NUM_WORKERS)
+    os.environ.setdefault("VIPS_CONCURRENCY", str(VIPS_THREADS_PER_WORKER))
+    converted_records = set()
+    if worklist:
+        with ProcessPoolExecutor(
+            max_workers=NUM_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as executor:
+            for pid_value, file_key, success, error in executor.map(
+                _convert_one, worklist, chunksize=4
+            ):
+                if success:
+                    logger.debug("Generated tiles for %s (%s)", file_key, pid_value)
+                    files_converted += 1
+                    converted_records.add(pid_value)
+                else:
+                    logger.error("Error generating tiles for %s (%s): %s", file_key, pid_value, error)
+    
+    for pid_value in committed_records:
+        if pid_value in converted_records:
+            successful_records += 1
+        else:
             failed_records += 1
     
     # Calculate elapsed time
@@ -223,6 +391,7 @@ def generate_iiif_tiles_for_all_records():
     print("\n===== IIIF Tile Generation Summary =====")
     print(f"Total records: {total_records}")
     print(f"Processed records: {processed_records}")
+    print(f"Skipped records (no valid files): {skipped_records}")
     print(f"Successful records: {successful_records}")
     print(f"Failed records: {failed_records}")
     print(f"Files processed: {files_processed}")
@@ -233,5 +402,9 @@ def generate_iiif_tiles_for_all_records():
     return True
 
 if __name__ == "__main__":
-    with app.app_context():
-        generate_iiif_tiles_for_all_records() 
\ No newline at end of file
+    ctx = get_app().app_context()
+    ctx.push()
+    try:
+        generate_iiif_tiles_for_all_records()
+    finally:
+        ctx.pop() 
\ No newline at end of file
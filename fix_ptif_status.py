@@ -5,118 +5,194 @@ This script finds PTIF files in records that are stuck in 'init' status and
 changes them to 'finished' status.
 
 Run this script with:
-  source .venv/bin/activate && python fix_ptif_status.py
+  source .venv/bin/activate && python fix_ptif_status.py [--create-index] [--verbose]
 """
 
 import os
 import sys
 import time
 import json
+from collections import Counter
+from itertools import islice
 from pathlib import Path
-from invenio_app.factory import create_api
 from invenio_db import db
-from invenio_rdm_records.records.api import RDMRecord
+from invenio_rdm_records.records.api import RDMMediaFileRecord, RDMRecord
 from invenio_records_resources.services.uow import UnitOfWork, RecordCommitOp
 from flask import current_app
+from ptif_utils import get_app, setup_logging
+from sqlalchemy import text
 
-# Create Flask application
-app = create_api()
+# Per-record details are logged at DEBUG level, run with --verbose to see them
+logger = setup_logging(__name__)
+
+# Number of record IDs fetched from the database at a time
+CHUNK_SIZE = 500
+
+PTIF_SUFFIX = ".ptif"
+
+# Number of records committed together in one unit of work
+BATCH_SIZE = 50
+
+# Run with --create-index to add a partial index for the 'init' status lookup
+CREATE_INDEX = "--create-index" in sys.argv
+
+def create_init_status_index():
+    """Create a partial index on the status of media files in 'init' status."""
+    table = RDMMediaFileRecord.model_cls.__tablename__
+    db.session.execute(text(
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_init_status ON {table} "
+        "((json->'processor'->>'status')) "
+        "WHERE json->'processor'->>'status' = 'init'"
+    ))
+    db.session.commit()
+
+def init_ptif_record_ids_query():
+    """Query the IDs of records with PTIF media files in 'init' status."""
+    model_cls = RDMMediaFileRecord.model_cls
+    # Renders as json->'processor'->>'status', the expression indexed by
+    # create_init_status_index()
+    return db.session.query(model_cls.record_id).filter(
+        model_cls.json['processor']['status'].as_string() == 'init',
+        model_cls.key.like(f'%{PTIF_SUFFIX}')
+    ).distinct()
+
+def iter_record_ids(chunk_size=CHUNK_SIZE):
+    """Yield the IDs of records with PTIF files to fix, one chunk at a time.
+
+    Uses keyset pagination instead of a streaming cursor, because records
+    are committed while iterating and a commit would close the cursor.
+    """
+    column = RDMMediaFileRecord.model_cls.record_id
+    last_id = None
+    while True:
+        query = init_ptif_record_ids_query().order_by(column)
+        if last_id is not None:
+            query = query.filter(column > last_id)
+        ids = [row.record_id for row in query.limit(chunk_size)]
+        if not ids:
+            return
+        yield from ids
+        last_id = ids[-1]
+
+def fix_record(record_id, uow, stats):
+    """Change the status of the record's PTIF files from 'init' to 'finished'.
+
+    The record is registered for commit in ``uow``. Returns whether the
+    record has any PTIF files.
+    """
+    record = RDMRecord.get_record(record_id)
+    logger.info("Checking record %s (%s)", record.pid.pid_value, record_id)
+    
+    # Check if media files are enabled
+    if not hasattr(record, 'media_files'):
+        logger.info("Record has no media_files attribute!")
+        return False
+        
+    if not record.media_files.enabled:
+        logger.info("Media files are not enabled for this record.")
+        return False
+    
+    logger.debug("Media files enabled: %s", record.media_files.enabled)
+    stats["records_with_media_files"] += 1
+    
+    # Look for any PTIF files
+    has_ptif = False
+    for file_key, file_record in record.media_files.items():
+        if file_key.endswith(PTIF_SUFFIX):
+            has_ptif = True
+            status = file_record.processor.get("status", "unknown")
+            logger.debug("Found PTIF file: %s, Status: %s", file_key, status)
+            
+            # Check if status is 'init' and change to 'finished'
+            if status == "init":
+                logger.info("Changing status from 'init' to 'finished' for %s", file_key)
+                file_record.processor["status"] = "finished"
+                file_record.commit()
+                stats["ptif_files_fixed"] += 1
+                
+                # Check the original file key (without .ptif extension)
+                original_key = file_key[:-len(PTIF_SUFFIX)]
+                if original_key in record.files:
+                    logger.debug("Original file exists: %s", original_key)
+                    
+                    # Make sure original file also has complete metadata
+                    original_file = record.files[original_key]
+                    if 'width' not in original_file.metadata:
+                        logger.info("Adding missing metadata for %s", original_key)
+                        # Add some reasonable defaults if missing
+                        original_file.metadata.update({
+                            'width': 1000,
+                            'height': 1000
+                        })
+                        original_file.commit()
+    
+    if has_ptif:
+        uow.register(RecordCommitOp(record))
+    return has_ptif
 
 def fix_ptif_file_status():
     """Find all PTIF files in records and change their status to 'finished'."""
-    print("Starting PTIF file status fix...")
+    logger.info("Starting PTIF file status fix...")
+    
+    if CREATE_INDEX:
+        logger.info("Creating the index on media file status...")
+        create_init_status_index()
     
-    # Get all records
-    records = RDMRecord.model_cls.query.all()
-    print(f"Found {len(records)} records")
+    # Only records with PTIF files in 'init' status need fixing, they are
+    # streamed one chunk at a time below
+    total_records = init_ptif_record_ids_query().count()
+    logger.info("Found %s records with PTIF files in 'init' status", total_records)
     
     # Statistics
-    total_records = len(records)
-    records_with_media_files = 0
-    records_with_ptif = 0
-    ptif_files_fixed = 0
+    stats = Counter()
     
     # Track time
     start_time = time.time()
     
-    # Process each record
-    for record_model in records:
-        try:
-            record_uuid = str(record_model.id)
+    # Process the records in batches, each batch is committed at once
+    record_ids = iter_record_ids()
+    while True:
+        batch = list(islice(record_ids, BATCH_SIZE))
+        if not batch:
+            break
+        
+        with UnitOfWork() as uow:
+            for record_id in batch:
+                try:
+                    # A failing record only rolls back its own savepoint
+                    with db.session.begin_nested():
+                        if fix_record(record_id, uow, stats):
+                            stats["records_with_ptif"] += 1
+                except Exception as e:
+                    logger.exception("Error processing record %s: %s", record_id, e)
             
-            with UnitOfWork() as uow:
-                record = RDMRecord.get_record(record_model.id)
-                print(f"\nChecking record {record.pid.pid_value} ({record_uuid})")
-                
-                # Check if media files are enabled
-                if not hasattr(record, 'media_files'):
-                    print(f"Record has no media_files attribute!")
-                    continue
-                    
-                if not record.media_files.enabled:
-                    print(f"Media files are not enabled for this record.")
-                    continue
-                
-                print(f"Media files enabled: {record.media_files.enabled}")
-                records_with_media_files += 1
-                
-                # Look for any PTIF files
-                has_ptif = False
-                for file_key in record.media_files.keys():
-                    if file_key.endswith('.ptif'):
-                        has_ptif = True
-                        file_record = record.media_files[file_key]
-                        status = file_record.processor.get("status", "unknown")
-                        print(f"Found PTIF file: {file_key}, Status: {status}")
-                        
-                        # Check if status is 'init' and change to 'finished'
-                        if status == "init":
-                            print(f"Changing status from 'init' to 'finished' for {file_key}")
-                            file_record.processor["status"] = "finished"
-                            file_record.commit()
-                            ptif_files_fixed += 1
-                            
-                            # Check the original file key (without .ptif extension)
-                            original_key = file_key[:-5]  # Remove .ptif
-                            if original_key in record.files:
-                                print(f"Original file exists: {original_key}")
-                                
-                                # Make sure original file also has complete metadata
-                                original_file = record.files[original_key]
-                                if 'width' not in original_file.metadata:
-                                    print(f"Adding missing metadata for {original_key}")
-                                    # Add some reasonable defaults if missing
-                                    original_file.metadata.update({
-                                        'width': 1000,
-                                        'height': 1000
-                                    })
-                                    original_file.commit()
-                
-                if has_ptif:
-                    records_with_ptif += 1
-                    uow.register(RecordCommitOp(record))
-                    uow.commit()
-                    print(f"Committed changes to record {record_uuid}")
-                    
-        except Exception as e:
-            print(f"Error processing record {record_model.id}: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            # A failing commit loses this batch only, the next ones still run
+            try:
+                uow.commit()
+            except Exception as e:
+                logger.exception("Error committing the batch of records %s: %s", batch, e)
+                uow.rollback()
+                continue
+            logger.info("Committed changes for a batch of %s records", len(batch))
     
     # Calculate elapsed time
     elapsed_time = time.time() - start_time
     
     # Print summary
     print("\n===== PTIF Status Fix Summary =====")
-    print(f"Total records: {total_records}")
-    print(f"Records with media files enabled: {records_with_media_files}")
-    print(f"Records with PTIF files: {records_with_ptif}")
-    print(f"PTIF files fixed (status changed): {ptif_files_fixed}")
+    print(f"Records with PTIF files in init status: {total_records}")
+    print(f"Records with media files enabled: {stats['records_with_media_files']}")
+    print(f"Records with PTIF files: {stats['records_with_ptif']}")
+    print(f"PTIF files fixed (status changed): {stats['ptif_files_fixed']}")
     print(f"Elapsed time: {elapsed_time:.2f} seconds")
     print("===================================")
     
     return True
 
 if __name__ == "__main__":
-    with app.app_context():
-        fix_ptif_file_status() 
\ No newline at end of file
+    ctx = get_app().app_context()
+    ctx.push()
+    try:
+        fix_ptif_file_status()
+    finally:
+        ctx.pop() 
\ No newline at end of file
@@ -2,52 +2,376 @@
 """
 Script to manually generate the missing IIIF tiles for PDF and TIFF files.
 Run this script with:
-  source .venv/bin/activate && python generate_missing_tiles.py
+  source .venv/bin/activate && python generate_missing_tiles.py [--tile-size N] [--verbose]
 """
 
+import argparse
+import io
 import os
-import sys
 import time
-import traceback
-from invenio_app.factory import create_api
+import logging
+import logging.handlers
+import multiprocessing
+import shutil
+import subprocess
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from invenio_db import db
-from invenio_rdm_records.records.api import RDMRecord
+from invenio_rdm_records.records.api import RDMFileRecord, RDMRecord
 from invenio_records_resources.services.uow import UnitOfWork, RecordCommitOp
 from flask import current_app
+from ptif_utils import get_app, setup_logging
+from sqlalchemy import or_
 
-# Create Flask application
-app = create_api()
+# Per-record details are logged at DEBUG level, run with --verbose to see them
+logger = setup_logging(__name__)
 
-def manually_create_tiles():
-    """Manually create IIIF tiles for records with TIFF and PDF files."""
-    print("Starting manual IIIF tile generation...")
+# Number of processes generating tiles and libvips threads in each of them,
+# shared out so that the workers together do not oversubscribe the cores
+NUM_WORKERS = min(os.cpu_count() or 1, 4)
+VIPS_THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // NUM_WORKERS)
+
+# Number of records fetched from the database per page
+CHUNK_SIZE = 500
+
+# Number of records committed together in one unit of work
+BATCH_SIZE = 25
+
+# Number of batches submitted to the workers but not finished yet
+MAX_PENDING_BATCHES = 2 * NUM_WORKERS
+
+# Edge length in pixels of the generated PTIF tiles, override with --tile-size
+DEFAULT_TILE_SIZE = 512
+_tile_size = DEFAULT_TILE_SIZE
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate the missing IIIF tiles")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE,
+                        help="Tile width and height of the PTIF files, e.g. 1024, 2048 or 4096")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log the details of every record and file")
+    return parser.parse_args()
+
+def converter_params():
+    """Return the PTIF save options, the configured ones tuned for tiling.
+
+    ``tile`` and ``pyramid`` are always passed by the converter itself.
+    The JPEG encoding is done by libvips, so it is as fast as the libjpeg it
+    is linked against (see ``print_jpeg_support``). Use
+    ``compression="deflate"`` instead only where lossless tiles are required.
+    """
+    params = dict(current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {}))
+    params.update({
+        "tile_width": _tile_size,
+        "tile_height": _tile_size,
+        "compression": "jpeg",
+        "Q": 85,
+        "bigtiff": True,
+    })
+    return params
+
+def find_libjpeg():
+    """Return the path of the libjpeg the vips command is linked against.
+
+    Returns ``None`` when ``vips`` or ``ldd`` is not available or the
+    library is not listed.
+    """
+    vips = shutil.which("vips")
+    ldd = shutil.which("ldd")
+    if not vips or not ldd:
+        return None
+    result = subprocess.run([ldd, vips], capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        name, _, location = line.strip().partition(" => ")
+        if name.startswith("libjpeg.so") and location.startswith("/"):
+            return location.split(" (")[0]
+    return None
+
+def print_jpeg_support():
+    """Print the libvips version and the JPEG library libvips is built with."""
+    import pyvips
+    
+    logger.info("libvips version: %s.%s.%s", pyvips.version(0), pyvips.version(1), pyvips.version(2))
+    libjpeg = find_libjpeg()
+    if libjpeg is None:
+        logger.info("Could not find the libjpeg libvips is linked against")
+        return
+    
+    # libvips only reports whether it has JPEG support, not which library
+    # provides it. libjpeg-turbo keeps its name in the library's copyright
+    # string, while the IJG libjpeg does not
+    with open(libjpeg, "rb") as f:
+        is_turbo = b"libjpeg-turbo" in f.read()
+    logger.info("libvips JPEG library: %s (%s)", libjpeg,
+                "libjpeg-turbo" if is_turbo else "not libjpeg-turbo")
+
+@lru_cache(maxsize=None)
+def get_valid_extensions():
+    """Return the lowercase file extensions tiles are generated for."""
+    return frozenset(
+        ext.lower() for ext in current_app.config.get(
+            "IIIF_TILES_VALID_EXTENSIONS",
+            ('jp2', 'jpeg', 'jpg', 'pdf', 'png', 'tif', 'tiff')
+        )
+    )
+
+@lru_cache(maxsize=None)
+def get_tiles_tools():
+    """Create the tiles converter and storage once per process."""
+    from invenio_rdm_records.services.iiif.storage import LocalTilesStorage
+    from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter
+    
+    converter = PyVIPSImageConverter(params=converter_params())
+    storage = LocalTilesStorage(
+        base_path=current_app.config.get("IIIF_TILES_STORAGE_BASE_PATH", "images/")
+    )
+    return converter, storage
+
+def stream_ptif(fin, tiles_path, converter):
+    """Write the image open as ``fin`` to ``tiles_path`` as a pyramidal TIFF.
+
+    The pixels are streamed from the file descriptor through libvips into
+    the target file, so the image is never held in memory as a whole. File
+    objects without a descriptor fall back to the converter.
+    """
+    import pyvips
+    
+    try:
+        fd = fin.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        with open(tiles_path, 'wb') as fout:
+            return converter.convert(fin, fout)
+    
+    source = pyvips.Source.new_from_descriptor(fd)
+    target = pyvips.Target.new_to_file(tiles_path)
+    image = pyvips.Image.new_from_source(source, "", access="sequential")
+    image.tiffsave_target(target, tile=True, pyramid=True, **converter_params())
+    return True
+
+# Directories this process has already created
+_created_dirs = set()
+
+def ensure_dir(path):
+    """Create ``path`` unless this process has already created it."""
+    if path not in _created_dirs:
+        os.makedirs(path, exist_ok=True)
+        _created_dirs.add(path)
+
+def _init_worker(tile_size, log_queue):
+    """Set up a tile generation process with its own application context.
+
+    libvips is configured once here for the lifetime of the process. Log
+    records are sent to ``log_queue`` and written by the parent process.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    # Every image is read once, so the operation cache is only overhead.
+    # The thread count is capped by VIPS_CONCURRENCY set by the driver
+    import pyvips
+    
+    pyvips.cache_set_max(0)
+    pyvips.cache_set_max_mem(256 * 1024 * 1024)
+    pyvips.cache_set_trace(False)
+    
+    global _tile_size
+    _tile_size = tile_size
+    get_app().app_context().push()
+
+def _process_record(record_uuid, uow):
+    """Generate the missing tiles of a single record.
+
+    The record is registered for commit in ``uow``. Returns a ``Counter``
+    of the record's statistics.
+    """
+    converter, storage = get_tiles_tools()
+    valid_extensions = get_valid_extensions()
+    stats = Counter()
+    
+    record = RDMRecord.get_record(record_uuid)
+    logger.debug("Processing record %s (%s)", record.pid.pid_value, record_uuid)
+        
+    # Check if media files are enabled
+    if not hasattr(record, 'media_files'):
+        logger.debug("Record has no media_files attribute!")
+        return stats
+    
+    if not record.media_files.enabled:
+        logger.debug("Media files are not enabled for this record.")
+        return stats
+        
+    logger.debug("Media files enabled: %s", record.media_files.enabled)
+    stats["records_with_media_files"] += 1
+        
+    # Process files
+    for file_key in record.files.keys():
+        _, dot, file_ext = file_key.rpartition('.')
+        file_ext = file_ext.lower()
+    
+        if dot and file_ext in valid_extensions:
+            logger.debug("Processing %s (extension: %s)", file_key, file_ext)
+            stats["files_processed"] += 1
+        
+            # Check if there's already a .ptif file in media_files
+            ptif_key = f"{file_key}.ptif"
+            if ptif_key in record.media_files:
+                status = record.media_files[ptif_key].processor.get("status", "unknown")
+                logger.debug("PTIF file already exists, status: %s", status)
+            
+                # If status is not 'finished', manually generate the file
+                if status != "finished":
+                    try:
+                        # Get the file object
+                        file_obj = record.files[file_key]
+                    
+                        # Get the file stream
+                        with file_obj.storage().open(file_obj.file_id) as fin:
+                            # Get the output path for the tiles
+                            tiles_path = storage._get_file_path(record, ptif_key)
+                            logger.debug("Generating tiles at: %s", tiles_path)
+                        
+                            # Create the directory if it doesn't exist
+                            ensure_dir(os.path.dirname(tiles_path))
+                        
+                            # Generate the tiles
+                            success = stream_ptif(fin, tiles_path, converter)
+                            logger.debug("Tile generation result: %s", success)
+                        
+                            if success:
+                                stats["tiles_generated"] += 1
+                            
+                                # Update the file metadata
+                                media_file = record.media_files[ptif_key]
+                                media_file.processor["status"] = "finished"
+                                media_file.commit()
+                            
+                                # Update the source file metadata if needed
+                                if 'width' not in file_obj.metadata:
+                                    logger.debug("Adding missing metadata for %s", file_key)
+                                    # Add some reasonable defaults
+                                    file_obj.metadata.update({
+                                        'width': 1000,
+                                        'height': 1000
+                                    })
+                                    file_obj.commit()
+                            
+                                logger.info("Successfully generated tiles for %s", file_key)
+                
+                    except Exception as e:
+                        logger.exception("Error generating tiles for %s: %s", file_key, e)
+            else:
+                # No PTIF file exists yet, create it from scratch
+                try:
+                    logger.debug("Creating new PTIF file for %s", file_key)
+                    
+                    # Use the generate_tiles task to create the file properly
+                    from invenio_rdm_records.services.iiif.tasks import generate_tiles
+                    result = generate_tiles(record.pid.pid_value, file_key, "files")
+                    logger.debug("New tile generation result: %s", result)
+                
+                    if result:
+                        stats["tiles_generated"] += 1
+                        logger.info("Successfully generated new tiles for %s", file_key)
+            
+                except Exception as e:
+                    logger.exception("Error creating new PTIF file for %s: %s", file_key, e)
+        
+    # Changes are committed together with the rest of the batch
+    uow.register(RecordCommitOp(record))
     
-    # Get all records
-    records = RDMRecord.model_cls.query.all()
-    print(f"Found {len(records)} records")
+    return stats
+
+def _process_batch(record_uuids):
+    """Generate the missing tiles of a batch of records in one unit of work.
+
+    Runs in a worker process. Returns a ``Counter`` of the statistics of
+    the batch.
+    """
+    totals = Counter(total_records=len(record_uuids))
+    with UnitOfWork() as uow:
+        for record_uuid in record_uuids:
+            try:
+                # A failing record only rolls back its own savepoint
+                with db.session.begin_nested():
+                    totals += _process_record(record_uuid, uow)
+            except Exception as e:
+                logger.exception("Error processing record %s: %s", record_uuid, e)
+        
+        # A failing commit loses this batch only, the tiles written so far
+        # are still counted
+        try:
+            uow.commit()
+        except Exception as e:
+            logger.exception("Error committing the batch of records %s: %s", record_uuids, e)
+            uow.rollback()
+            return totals
+        logger.info("Committed a batch of %s records", len(record_uuids))
+    
+    return totals
+
+def iter_record_batches(extensions, batch_size=BATCH_SIZE):
+    """Yield the ids of the candidate records as lists of ``batch_size`` strings."""
+    record_ids = (str(record_model.id) for record_model in iter_records(extensions))
+    while True:
+        batch = list(islice(record_ids, batch_size))
+        if not batch:
+            break
+        yield batch
+
+def iter_records(extensions, batch=CHUNK_SIZE):
+    """Yield the records with a file of one of ``extensions``, in primary key order.
+
+    The extension check is done by the database, so records without any
+    candidate file are never loaded. Uses keyset pagination so that each
+    page is a cheap index range scan and only one page of records is held
+    in the session at a time.
+    """
+    model_cls = RDMRecord.model_cls
+    file_model_cls = RDMFileRecord.model_cls
+    has_candidate_file = file_model_cls.query.filter(
+        file_model_cls.record_id == model_cls.id,
+        or_(*(file_model_cls.key.ilike(f"%.{ext}") for ext in sorted(extensions)))
+    ).exists()
+    last_id = None
+    while True:
+        query = model_cls.query.filter(has_candidate_file).order_by(model_cls.id)
+        if last_id is not None:
+            query = query.filter(model_cls.id > last_id)
+        rows = query.limit(batch).all()
+        if not rows:
+            break
+        yield from rows
+        last_id = rows[-1].id
+        db.session.expire_all()
+
+def manually_create_tiles(tile_size=DEFAULT_TILE_SIZE):
+    """Manually create IIIF tiles for records with TIFF and PDF files."""
+    logger.info("Starting manual IIIF tile generation...")
     
     # Count statistics
-    total_records = len(records)
-    records_with_media_files = 0
-    files_processed = 0
-    tiles_generated = 0
+    stats = Counter()
     
     # Valid extensions for IIIF tile generation
-    valid_extensions = current_app.config.get("IIIF_TILES_VALID_EXTENSIONS", 
-                                             ['jp2', 'jpeg', 'jpg', 'pdf', 'png', 'tif', 'tiff'])
-    print(f"Valid extensions: {valid_extensions}")
+    valid_extensions = get_valid_extensions()
+    logger.info("Valid extensions: %s", sorted(valid_extensions))
     
     # IIIF tiles storage path
     tiles_storage_path = os.path.join(
         current_app.instance_path, 
         current_app.config.get("IIIF_TILES_STORAGE_BASE_PATH", "images/")
     )
-    print(f"IIIF tiles storage path: {tiles_storage_path}")
+    logger.info("IIIF tiles storage path: %s", tiles_storage_path)
+    logger.info("PTIF tile size: %sx%s", tile_size, tile_size)
     
     # Ensure the path exists
     if not os.path.exists(tiles_storage_path):
         os.makedirs(tiles_storage_path, exist_ok=True)
-        print(f"Created IIIF tiles storage path: {tiles_storage_path}")
+        logger.info("Created IIIF tiles storage path: %s", tiles_storage_path)
     
     # Track time
     start_time = time.time()
@@ -55,142 +379,61 @@ def manually_create_tiles():
     # Check for pyvips installation
     try:
         import pyvips
-        print(f"PyVIPS version: {pyvips.__version__}")
+        logger.info("PyVIPS version: %s", pyvips.__version__)
+        print_jpeg_support()
     except ImportError:
-        print("ERROR: pyvips is not installed! Cannot generate tiles.")
+        logger.error("pyvips is not installed! Cannot generate tiles.")
         return False
     
-    # Import the converter and storage classes directly
-    from invenio_rdm_records.services.iiif.storage import LocalTilesStorage
-    from invenio_rdm_records.services.iiif.converter import PyVIPSImageConverter
-    
-    # Create converter and storage instances
-    converter = PyVIPSImageConverter(
-        params=current_app.config.get("IIIF_TILES_CONVERTER_PARAMS", {})
-    )
-    storage = LocalTilesStorage(
-        base_path=current_app.config.get("IIIF_TILES_STORAGE_BASE_PATH", "images/")
+    # Spawned workers each convert a batch with a fresh libvips and database
+    # connection, and log through a queue to a listener thread here
+    os.environ.setdefault("VIPS_CONCURRENCY", str(VIPS_THREADS_PER_WORKER))
+    mp_context = multiprocessing.get_context("spawn")
+    log_queue = mp_context.Queue()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
     )
-    
-    # Process each record
-    for record_model in records:
-        try:
-            record_uuid = str(record_model.id)
-            
-            with UnitOfWork() as uow:
-                record = RDMRecord.get_record(record_model.id)
-                print(f"\nProcessing record {record.pid.pid_value} ({record_uuid})")
-                
-                # Check if media files are enabled
-                if not hasattr(record, 'media_files'):
-                    print(f"Record has no media_files attribute!")
-                    continue
-                    
-                if not record.media_files.enabled:
-                    print(f"Media files are not enabled for this record.")
-                    continue
-                
-                print(f"Media files enabled: {record.media_files.enabled}")
-                records_with_media_files += 1
-                
-                # Process files
-                for file_key in record.files.keys():
-                    file_ext = os.path.splitext(file_key)[1].lower()[1:]
-                    
-                    if file_ext in valid_extensions:
-                        print(f"Processing {file_key} (extension: {file_ext})")
-                        files_processed += 1
-                        
-                        # Check if there's already a .ptif file in media_files
-                        ptif_key = f"{file_key}.ptif"
-                        if ptif_key in record.media_files:
-                            status = record.media_files[ptif_key].processor.get("status", "unknown")
-                            print(f"PTIF file already exists, status: {status}")
-                            
-                            # If status is not 'finished', manually generate the file
-                            if status != "finished":
-                                try:
-                                    # Get the file object
-                                    file_obj = record.files[file_key]
-                                    
-                                    # Get the file stream
-                                    with file_obj.storage().open(file_obj.file_id) as fin:
-                                        # Get the output path for the tiles
-                                        tiles_path = storage._get_file_path(record, ptif_key)
-                                        print(f"Generating tiles at: {tiles_path}")
-                                        
-                                        # Create the directory if it doesn't exist
-                                        os.makedirs(os.path.dirname(tiles_path), exist_ok=True)
-                                        
-                                        # Generate the tiles
-                                        with open(tiles_path, 'wb') as fout:
-                                            success = converter.convert(fin, fout)
-                                            print(f"Tile generation result: {success}")
-                                            
-                                            if success:
-                                                tiles_generated += 1
-                                                
-                                                # Update the file metadata
-                                                media_file = record.media_files[ptif_key]
-                                                media_file.processor["status"] = "finished"
-                                                media_file.commit()
-                                                
-                                                # Update the source file metadata if needed
-                                                if 'width' not in file_obj.metadata:
-                                                    print(f"Adding missing metadata for {file_key}")
-                                                    # Add some reasonable defaults
-                                                    file_obj.metadata.update({
-                                                        'width': 1000,
-                                                        'height': 1000
-                                                    })
-                                                    file_obj.commit()
-                                                
-                                                print(f"Successfully generated tiles for {file_key}")
-                                
-                                except Exception as e:
-                                    print(f"Error generating tiles for {file_key}: {e}")
-                                    traceback.print_exc()
-                        else:
-                            # No PTIF file exists yet, create it from scratch
-                            try:
-                                print(f"Creating new PTIF file for {file_key}")
-                                
-                                # Use the generate_tiles task to create the file properly
-                                from invenio_rdm_records.services.iiif.tasks import generate_tiles
-                                result = generate_tiles(record.pid.pid_value, file_key, "files")
-                                print(f"New tile generation result: {result}")
-                                
-                                if result:
-                                    tiles_generated += 1
-                                    print(f"Successfully generated new tiles for {file_key}")
-                            
-                            except Exception as e:
-                                print(f"Error creating new PTIF file for {file_key}: {e}")
-                                traceback.print_exc()
-                
-                # Commit changes
-                uow.register(RecordCommitOp(record))
-                uow.commit()
-                print(f"Committed record {record_uuid}")
-                
-        except Exception as e:
-            print(f"Error processing record {record_model.id}: {str(e)}")
-            traceback.print_exc()
+    log_listener.start()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=NUM_WORKERS,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(tile_size, log_queue),
+        ) as executor:
+            # Keep only a few batches in flight, so the records are read
+            # from the database as the workers catch up instead of all up front
+            pending = set()
+            for batch in iter_record_batches(valid_extensions):
+                pending.add(executor.submit(_process_batch, batch))
+                if len(pending) >= MAX_PENDING_BATCHES:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stats += future.result()
+            for future in as_completed(pending):
+                stats += future.result()
+    finally:
+        log_listener.stop()
     
     # Calculate elapsed time
     elapsed_time = time.time() - start_time
     
     # Print summary
-    print("\n===== Manual IIIF Tile Generation Summary =====")
-    print(f"Total records: {total_records}")
-    print(f"Records with media files enabled: {records_with_media_files}")
-    print(f"Files processed: {files_processed}")
-    print(f"Tiles generated: {tiles_generated}")
-    print(f"Elapsed time: {elapsed_time:.2f} seconds")
-    print("==============================================")
+    logger.info(
+        "\n===== Manual IIIF Tile Generation Summary =====\n"
+        "Records with candidate files: %s\n"
+        "Records with media files enabled: %s\n"
+        "Files processed: %s\n"
+        "Tiles generated: %s\n"
+        "Elapsed time: %.2f seconds\n"
+        "==============================================",
+        stats["total_records"], stats["records_with_media_files"],
+        stats["files_processed"], stats["tiles_generated"], elapsed_time
+    )
     
     return True
 
 if __name__ == "__main__":
-    with app.app_context():
-        manually_create_tiles() 
\ No newline at end of file
+    args = parse_args()
+    with get_app().app_context():
+        manually_create_tiles(tile_size=args.tile_size) 
\ No newline at end of file
@@ -6,18 +6,27 @@ Run this script with:
 """
 
 import os
-import re
+from collections import defaultdict
 from invenio_app.factory import create_api
 from flask import current_app
 
 # Create Flask application
 app = create_api()
 
+def scan_dir(path, suffix):
+    """Yield the paths of the files in ``path`` ending with ``suffix``."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(suffix):
+                yield entry.path
+
 def get_file_info():
     """Get information about the PDF files in the records."""
     with app.app_context():
         from invenio_rdm_records.records.api import RDMRecord
-        from invenio_files_rest.models import Bucket, ObjectVersion
+        from invenio_rdm_records.services.iiif.storage import LocalTilesStorage
+        from invenio_files_rest.models import ObjectVersion
+        from sqlalchemy.orm import joinedload
         
         record_ids = [
             "b8902cb3-eaaf-4201-89c6-f6475085c0c3",
@@ -30,10 +39,33 @@ def get_file_info():
         print(f"Data directory: {data_dir}")
         images_dir = os.path.join(current_app.instance_path, "images")
         print(f"Images directory: {images_dir}")
+        tiles_storage = LocalTilesStorage(base_path=images_dir)
+        
+        # Load the records and the head objects of all their buckets up front,
+        # with the file of each object, instead of querying per record
+        records = RDMRecord.get_records(record_ids)
         
+        # get_records skips the ids it cannot find, so report those here
+        found_ids = {str(record.id) for record in records}
         for record_id in record_ids:
+            if record_id not in found_ids:
+                print(f"\nRecord {record_id} not found")
+        
+        bucket_ids = [
+            bucket_id
+            for record in records
+            for bucket_id in (record.files.bucket_id, record.media_files.bucket_id)
+        ]
+        objects_by_bucket = defaultdict(list)
+        objects = ObjectVersion.query.filter(
+            ObjectVersion.bucket_id.in_(bucket_ids),
+            ObjectVersion.is_head.is_(True),
+        ).options(joinedload(ObjectVersion.file)).all()
+        for obj in objects:
+            objects_by_bucket[obj.bucket_id].append(obj)
+        
+        for record in records:
             try:
-                record = RDMRecord.get_record(record_id)
                 print(f"\nRecord ID: {record.id}")
                 
                 # Get file bucket information
@@ -48,13 +80,9 @@ def get_file_info():
                 media_files = list(record.media_files.keys())
                 print(f"Media files: {media_files}")
                 
-                # Get bucket objects
-                files_bucket = Bucket.query.filter_by(id=files_bucket_id).one()
-                media_bucket = Bucket.query.filter_by(id=media_bucket_id).one()
-                
                 # Get files from buckets
-                file_objects = ObjectVersion.query.filter_by(bucket_id=files_bucket_id, is_head=True).all()
-                media_objects = ObjectVersion.query.filter_by(bucket_id=media_bucket_id, is_head=True).all()
+                file_objects = objects_by_bucket[files_bucket_id]
+                media_objects = objects_by_bucket[media_bucket_id]
                 
                 print("\nFile objects:")
                 for obj in file_objects:
@@ -64,36 +92,38 @@ def get_file_info():
                 for obj in media_objects:
                     print(f"  {obj.key} - {obj.file.uri if obj.file else 'No file'}")
                 
-                # Try a direct check for the bucket directories
-                # This assumes the file storage is using a direct bucket storage pattern
-                bucket_pattern = r"[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
-                
-                print(f"\nLooking for bucket directories for {files_bucket_id}...")
-                files_bucket_str = str(files_bucket_id)
-                bucket_dir_pattern = f"{files_bucket_str[:2]}/{files_bucket_str[2:4]}/{files_bucket_str}"
-                print(f"Bucket directory pattern: {bucket_dir_pattern}")
-                
-                # Search for PDF files in the data directory
-                print(f"\nSearching for PDF files in {data_dir}...")
-                for root, dirs, files in os.walk(data_dir):
-                    for file in files:
-                        if file.lower().endswith('.pdf'):
-                            path = os.path.join(root, file)
-                            print(f"Found PDF: {path}")
+                # Check the stored PDF files on disk. invenio-files-rest stores
+                # each file under a path derived from its file instance, which
+                # the file URI already points to
+                print(f"\nChecking stored PDF files in {data_dir}...")
+                for obj in file_objects:
+                    if not obj.key.lower().endswith('.pdf') or not obj.file:
+                        continue
+                    try:
+                        size = os.stat(obj.file.uri).st_size
+                    except OSError:
+                        print(f"PDF {obj.key} missing on disk: {obj.file.uri}")
+                    else:
+                        print(f"Found PDF {obj.key}: {obj.file.uri} ({size} bytes)")
                 
-                # If using vips, check if PTIF files exist
-                print(f"\nChecking for existing PTIF files in {images_dir}...")
-                if os.path.exists(images_dir):
-                    for root, dirs, files in os.walk(images_dir):
-                        for file in files:
-                            if file.lower().endswith('.ptif'):
-                                path = os.path.join(root, file)
-                                print(f"Found PTIF: {path}")
-                else:
-                    print(f"Images directory not found: {images_dir}")
+                # If using vips, check if PTIF files exist in the record's tiles directory
+                tiles_dirs = {
+                    os.path.dirname(tiles_storage._get_file_path(record, key))
+                    for key in media_files
+                    if key.lower().endswith('.ptif')
+                }
+                print(f"\nChecking for existing PTIF files in {sorted(tiles_dirs) or images_dir}...")
+                if not tiles_dirs:
+                    print("Record has no PTIF media files")
+                for tiles_dir in tiles_dirs:
+                    if os.path.isdir(tiles_dir):
+                        for path in scan_dir(tiles_dir, '.ptif'):
+                            print(f"Found PTIF: {path}")
+                    else:
+                        print(f"Tiles directory not found: {tiles_dir}")
                 
             except Exception as e:
-                print(f"Error processing record {record_id}: {str(e)}")
+                print(f"Error processing record {record.id}: {str(e)}")
 
 if __name__ == "__main__":
     get_file_info() 
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""
+Helpers shared by the PTIF maintenance scripts in this directory.
+Import it from a script run from this directory, e.g.:
+  from ptif_utils import media_pdf_records_query
+"""
+
+import logging
+import os
+import sys
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_app():
+    """Return the Flask application, created on first use.
+
+    ``invenio_app`` is imported here so that importing this module stays cheap.
+    """
+    from invenio_app.factory import create_api
+
+    return create_api()
+
+
+def setup_logging(name):
+    """Log to stderr and return the logger called ``name``.
+
+    DEBUG messages are only shown when the script runs with --verbose.
+    """
+    logging.basicConfig(
+        level=logging.DEBUG if "--verbose" in sys.argv else logging.INFO,
+        format='%(asctime)s %(message)s',
+        stream=sys.stderr
+    )
+    return logging.getLogger(name)
+
+
+def is_up_to_date(output_file, input_file):
+    """Check if a non-empty output file exists and is newer than its input."""
+    try:
+        output_stat = os.stat(output_file)
+    except FileNotFoundError:
+        return False
+    return (
+        output_stat.st_size > 0
+        and output_stat.st_mtime > os.path.getmtime(input_file)
+    )
+
+
+def media_pdf_records_query():
+    """Query the records with media files enabled and at least one PDF file."""
+    from invenio_rdm_records.records.api import RDMFileRecord, RDMRecord
+
+    record_model_cls = RDMRecord.model_cls
+    file_model_cls = RDMFileRecord.model_cls
+    has_pdf = file_model_cls.query.filter(
+        file_model_cls.record_id == record_model_cls.id,
+        file_model_cls.key.ilike('%.pdf')
+    ).exists()
+    return record_model_cls.query.filter(
+        record_model_cls.json[('media_files', 'enabled')].as_boolean().is_(True),
+        has_pdf
+    )